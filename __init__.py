@@ -50,15 +50,28 @@ __contributors__ = {}
 # This is a url where the most recent plugin package can be downloaded.
 __url__ = '' # 'http://supybot.com/Members/yourname/Whatis/download'
 
-import config
-import plugin
+try:
+    reload
+except NameError:
+    from importlib import reload
+
+from . import config
+from . import timing
+from . import matcher
+from . import bulk
+from . import aio
+from . import plugin
+reload(timing)
+reload(matcher)
+reload(bulk)
+reload(aio)
 reload(plugin) # In case we're being reloaded.
 reload(config)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
 
 if world.testing:
-    import test
+    from . import test
 
 Class = plugin.Class
 configure = config.configure
@@ -0,0 +1,225 @@
+###
+# Copyright (c) 2009-2014, Torrie Fischer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Runs a Whatis database on worker threads for asyncio code, as an
+alternative to plugin.ThreadProtectionFacade for bots embedded in an asyncio
+service.  Needs Python 3; on Python 2 this module imports but
+AsyncioFacade can't be created.
+
+    db = aio.AsyncioFacade(plugin.WhatisDB, workers=4, timeout=2, loop=loop)
+    reaction = await db.produceReaction('#channel', text)
+
+plugin.PromiseAdapter puts the Promise interface back on top of it, so the
+plugin itself can share the same threads:
+
+    whatis.db._dispose()
+    whatis.db = plugin.PromiseAdapter(db)
+"""
+
+import time
+import functools
+
+import supybot.ircutils as ircutils
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None
+
+try:
+    from . import timing
+except (ImportError, ValueError):
+    # Run or imported on its own, outside the plugin package.
+    import timing
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+class _Shard(object):
+    """One copy of the wrapped object, and the only thread that uses it."""
+    def __init__(self, makeWrapped, name):
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, name)
+        self.processed = 0
+        self.waited = 0.0
+        self.maxWait = 0.0
+        self.timings = {}
+        try:
+            self.wrapped = self.executor.submit(makeWrapped).result()
+        except Exception:
+            self.executor.shutdown(wait=False)
+            raise
+
+    def run(self, key, queued, args, kwargs):
+        start = time.time()
+        waited = start - queued
+        self.processed += 1
+        self.waited += waited
+        self.maxWait = max(self.maxWait, waited)
+        if key not in self.timings:
+            self.timings[key] = (timing.Histogram(), timing.Histogram())
+        (waits, runs) = self.timings[key]
+        waits.add(waited)
+        try:
+            return getattr(self.wrapped, key)(*args, **kwargs)
+        finally:
+            runs.add(time.time() - start)
+
+    def submit(self, key, args, kwargs):
+        return self.executor.submit(self.run, key, time.time(), args, kwargs)
+
+    def stats(self):
+        return {
+            'queued': self.executor._work_queue.qsize(),
+            'processed': self.processed,
+            'averageWait': self.waited / max(self.processed, 1),
+            'maxWait': self.maxWait
+        }
+
+class AsyncioFacade(object):
+    """Exposes the methods of wrappedClass (such as getReactions,
+    produceReaction, addReaction and forgetReaction) as functions returning
+    asyncio futures.
+
+    As with ThreadProtectionFacade, each of the workers threads gets its
+    own instance of wrappedClass, since SQLite connections can't be shared
+    between threads.  Calls whose first argument is a channel always go to
+    the same thread, as key(channel) decides (ircutils.toLower unless
+    given, so #Foo[] and #foo{} share one); other calls go to every
+    thread and resolve to the list of their results.  Cancelling a future
+    drops its call if it hasn't started yet, and a call which hasn't
+    finished after timeout seconds fails with asyncio.TimeoutError.
+
+    Create it from a coroutine, or pass the loop the futures belong to.
+    """
+    def __init__(self, wrappedClass, *args, **kwargs):
+        if asyncio is None:
+            raise RuntimeError('AsyncioFacade needs Python 3.')
+        workers = kwargs.pop('workers', 1)
+        self.loop = kwargs.pop('loop', None) or asyncio.get_event_loop()
+        self.timeout = kwargs.pop('timeout', None)
+        self.key = kwargs.pop('key', None) or ircutils.toLower
+        makeWrapped = functools.partial(wrappedClass, *args, **kwargs)
+        self.shards = []
+        try:
+            for i in range(max(workers, 1)):
+                self.shards.append(_Shard(makeWrapped,
+                                          'AsyncioFacade-%i' % i))
+        except Exception:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        """Stops the worker threads once the calls already queued are done."""
+        for shard in self.shards:
+            shard.executor.shutdown(wait=True)
+
+    def _shardFor(self, channel):
+        return self.shards[hash(self.key(channel)) % len(self.shards)]
+
+    def queueDepth(self, channel):
+        """Returns the number of calls waiting ahead of a call for channel."""
+        return self._shardFor(channel).executor._work_queue.qsize()
+
+    def stats(self):
+        """Returns the queue depth and wait times of every thread."""
+        return [shard.stats() for shard in self.shards]
+
+    def methodStats(self):
+        """Returns the queue wait and run time Histograms of every method,
+        summed over all threads."""
+        methods = {}
+        for shard in self.shards:
+            for (key, (waits, runs)) in list(shard.timings.items()):
+                if key not in methods:
+                    methods[key] = (timing.Histogram(), timing.Histogram())
+                methods[key][0].merge(waits)
+                methods[key][1].merge(runs)
+        return methods
+
+    def submit(self, key, *args, **kwargs):
+        """Calls the method key on the threads it belongs to, and returns a
+        list of their concurrent.futures.Future objects.  This doesn't need
+        the event loop, so it also suits code which isn't asyncio based."""
+        if args and isinstance(args[0], basestring):
+            shards = [self._shardFor(args[0])]
+        else:
+            shards = self.shards
+        return [shard.submit(key, args, kwargs) for shard in shards]
+
+    def _wrap(self, key, future):
+        loop = self.loop
+        wrapped = loop.create_future()
+        def settle(future):
+            if wrapped.done():
+                return
+            if future.cancelled():
+                wrapped.cancel()
+            elif future.exception() is not None:
+                wrapped.set_exception(future.exception())
+            else:
+                wrapped.set_result(future.result())
+        def finished(future):
+            try:
+                loop.call_soon_threadsafe(settle, future)
+            except RuntimeError:
+                # The loop was closed; nobody is waiting anymore.
+                pass
+        future.add_done_callback(finished)
+        if self.timeout is not None:
+            def expire():
+                if not wrapped.done():
+                    wrapped.set_exception(asyncio.TimeoutError(
+                        '%s took more than %ss' % (key, self.timeout)))
+            timer = loop.call_later(self.timeout, expire)
+            wrapped.add_done_callback(lambda wrapped: timer.cancel())
+        # Does nothing once the call has finished.
+        wrapped.add_done_callback(lambda wrapped: future.cancel())
+        return wrapped
+
+    def __getattr__(self, key):
+        if key == 'shards':
+            raise AttributeError(key)
+        val = getattr(self.shards[0].wrapped, key)
+        if not callable(val):
+            return val
+        @functools.wraps(val)
+        def call(*args, **kwargs):
+            futures = [self._wrap(key, future)
+                       for future in self.submit(key, *args, **kwargs)]
+            if args and isinstance(args[0], basestring):
+                return futures[0]
+            return asyncio.gather(*futures)
+        return call
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,406 @@
+###
+# Copyright (c) 2009-2014, Torrie Fischer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Benchmarks the Whatis hot paths against synthetic channels.
+
+    python bench.py [--channels N] [--patterns N] [--messages N] ...
+
+Every channel is filled with randomly generated patterns of the shapes given
+by --shapes, then a corpus of messages (generated, or read one per line from
+--corpus) is replayed through SQLiteWhatisDB.produceReaction, getReactions,
+suggestPatterns and a ThreadProtectionFacade round trip.  Filling the channels measures
+addReaction.  Results are written as JSON: throughput and p50/p99 latencies
+for each operation.  Runs with the same --seed use the same data.
+
+With --processes 1,2,4 the messages are also replayed through a
+ProcessFacade with each of those numbers of processes, to measure how
+matching scales with cores.  The speedup can't exceed the number of CPUs,
+which is reported along with it.  With --memory N, N reactions spread over the channels
+are also loaded into in-memory matchers, and the memory they take is
+reported.
+"""
+
+import os
+import sys
+import json
+import atexit
+import logging
+import time
+import types
+import random
+import shutil
+import multiprocessing
+import argparse
+import tempfile
+
+SHAPES = {
+    'word': lambda w: w(),
+    'phrase': lambda w: '%s %s' % (w(), w()),
+    'regex': lambda w: r'\b%s\w*' % w(),
+    'anchored': lambda w: '^%s' % w(),
+    'alternation': lambda w: '(%s|%s) %s' % (w(), w(), w()),
+    'unindexed': lambda w: r'[%s]\d{2,}' % w(),
+}
+
+SYLLABLES = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+
+def makeWord(rng):
+    return ''.join(rng.choice(SYLLABLES) for i in range(rng.randint(3, 4)))
+
+def parseShapes(spec):
+    """Parses "word=70,regex=30" into a list of (shape, weight) pairs."""
+    shapes = []
+    for part in spec.split(','):
+        (name, weight) = part.split('=')
+        if name not in SHAPES:
+            raise ValueError('Unknown pattern shape %r; known shapes: %s' %
+                             (name, ', '.join(sorted(SHAPES))))
+        shapes.append((name, float(weight)))
+    return shapes
+
+def makePatterns(rng, count, shapes):
+    word = lambda: makeWord(rng)
+    total = sum(weight for (name, weight) in shapes)
+    patterns = set()
+    while len(patterns) < count:
+        r = rng.random() * total
+        for (name, weight) in shapes:
+            r -= weight
+            if r <= 0:
+                break
+        patterns.add(SHAPES[name](word))
+    return sorted(patterns)
+
+def makeMessages(rng, count, vocabulary):
+    """Generates count IRC-sized lines, mostly of words taken from the
+    patterns so that a realistic share of them match something."""
+    messages = []
+    for i in range(count):
+        words = []
+        for j in range(rng.randint(3, 20)):
+            if vocabulary and rng.random() < 0.05:
+                words.append(rng.choice(vocabulary))
+            else:
+                words.append(makeWord(rng))
+        messages.append(' '.join(words))
+    return messages
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    def percentile(p):
+        if not latencies:
+            return None
+        i = min(len(latencies) - 1, int(round(p / 100.0 * len(latencies))))
+        return latencies[i] * 1000
+    return {
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / max(elapsed, 1e-9),
+        'p50_ms': percentile(50),
+        'p99_ms': percentile(99),
+    }
+
+def timed(calls):
+    """Runs every call, returning their summarized latencies."""
+    latencies = []
+    start = time.time()
+    for call in calls:
+        before = time.time()
+        call()
+        latencies.append(time.time() - before)
+    return summarize(latencies, time.time() - start)
+
+def deepSize(obj):
+    """Returns the size in bytes of obj and everything it refers to, counting
+    objects referred to more than once only once."""
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType,
+                types.FunctionType, types.MethodType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in getattr(cls, '__slots__', ()):
+                    if hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return size
+
+def measureMemory(rng, matcher, count, channels, shapes):
+    """Loads count reactions, spread over channels, into ChannelMatchers the
+    way they come out of the database, and returns their size."""
+    persons = ['nick%i' % i for i in range(50)]
+    def copy(s):
+        # Every row the database returns holds strings of its own.
+        return (s + ' ')[:-1]
+    matchers = []
+    for channel in range(channels):
+        rows = []
+        perChannel = count // channels
+        if channel < count % channels:
+            perChannel += 1
+        for pattern in makePatterns(rng, perChannel, shapes):
+            if len(rows) >= perChannel:
+                break
+            for i in range(rng.randint(1, 3)):
+                reaction = ' '.join([makeWord(rng) for j in range(4)])
+                rows.append((copy(pattern), reaction,
+                             copy(rng.choice(persons)), 1.0))
+        rows = rows[:perChannel]
+        matchers.append(matcher.ChannelMatcher(rows, 0))
+    for m in matchers:
+        # Builds the literal index.
+        m.match('')
+    reactions = sum([len(r) for m in matchers for r in m.reactions.values()])
+    patterns = sum([len(m.reactions) for m in matchers])
+    size = deepSize(matchers)
+    records = deepSize([m.reactions for m in matchers])
+    return {
+        'reactions': reactions,
+        'patterns': patterns,
+        'bytes': size,
+        'bytesPerReaction': size / max(reactions, 1),
+        'recordBytesPerReaction': records / max(reactions, 1),
+    }
+
+def measureScaling(plugin, filename, kwargs, channels, replay, counts):
+    """Replays the messages through a ProcessFacade with each of the given
+    numbers of processes, everything queued at once, and returns the
+    throughput of each."""
+    scaling = {'cpus': multiprocessing.cpu_count()}
+    base = None
+    for count in counts:
+        facade = plugin.ProcessFacade(plugin.SQLiteWhatisDB, filename,
+                                      processes=count, **kwargs)
+        try:
+            # Loads the matchers first, in every process.
+            for channel in channels:
+                facade.getReactions(channel, '').result()
+            start = time.time()
+            promises = [facade.produceReaction(*r) for r in replay]
+            for p in promises:
+                p.result()
+            elapsed = time.time() - start
+        finally:
+            facade.close().result()
+            facade._dispose()
+        throughput = len(promises) / max(elapsed, 1e-9)
+        if base is None:
+            base = throughput
+        scaling[str(count)] = {
+            'ops': len(promises),
+            'seconds': elapsed,
+            'throughput': throughput,
+            'speedup': throughput / base,
+        }
+    return scaling
+
+def run(options, plugin):
+    rng = random.Random(options.seed)
+    shapes = parseShapes(options.shapes)
+    channels = ['#bench%i' % i for i in range(options.channels)]
+    filename = os.path.join(options.directory, 'Whatis.bench.db')
+    kwargs = {
+        'batchSize': options.batch_size,
+        'batchInterval': 3600,
+        'cacheSize': options.cache_size,
+    }
+    db = plugin.SQLiteWhatisDB(filename, **kwargs)
+    results = {}
+
+    corpus = None
+    if options.corpus:
+        f = open(options.corpus)
+        try:
+            corpus = [line.rstrip('\r\n') for line in f if line.strip()]
+        finally:
+            f.close()
+
+    adds = []
+    lookups = []
+    messages = {}
+    for channel in channels:
+        patterns = makePatterns(rng, options.patterns, shapes)
+        for pattern in patterns:
+            adds.append((channel, pattern, makeWord(rng)))
+        lookups.extend((channel, p) for p in rng.sample(patterns,
+                       min(len(patterns), options.lookups)))
+        vocabulary = [w for p in patterns for w in p.split()
+                      if w.isalpha()]
+        messages[channel] = corpus or makeMessages(rng, options.messages,
+                                                   vocabulary)
+    replay = [(channel, text) for channel in channels
+              for text in messages[channel]]
+    rng.shuffle(replay)
+
+    results['addReaction'] = timed(
+        [lambda a=a: db.addReaction(*a) for a in adds])
+    db.close()
+    # Loading the matchers is a one-off cost, measured on its own.
+    db = plugin.SQLiteWhatisDB(filename, **kwargs)
+    results['loadMatchers'] = timed(
+        [lambda c=c: db._getMatcher(c) for c in channels])
+    results['getReactions'] = timed(
+        [lambda l=l: db.getReactions(*l) for l in lookups])
+    # So is indexing the patterns for suggestions, which happens on the
+    # first suggestPatterns call.  The lookups are made with a typo.
+    results['indexSimilarity'] = timed(
+        [lambda c=c: db.suggestPatterns(c, '', 0) for c in channels])
+    typos = [(c, p[:len(p) // 2] + p[len(p) // 2 + 1:]) for (c, p) in lookups]
+    results['suggestPatterns'] = timed(
+        [lambda t=t: db.suggestPatterns(t[0], t[1], 2) for t in typos])
+    matched = [0]
+    def produce(channel, text):
+        if db.produceReaction(channel, text) is not None:
+            matched[0] += 1
+    results['produceReaction'] = timed(
+        [lambda r=r: produce(*r) for r in replay])
+    results['produceReaction']['matched'] = matched[0]
+    db.close()
+
+    facade = plugin.ThreadProtectionFacade(plugin.SQLiteWhatisDB, filename,
+                                           workers=options.workers, **kwargs)
+    try:
+        for channel in channels:
+            facade.getReactions(channel, '').result()
+        results['facadeRoundTrip'] = timed(
+            [lambda r=r: facade.produceReaction(*r).result()
+             for r in replay])
+        # Everything queued at once, so the shards work in parallel.
+        start = time.time()
+        promises = [facade.produceReaction(*r) for r in replay]
+        for p in promises:
+            p.result()
+        elapsed = time.time() - start
+        results['facadeThroughput'] = {
+            'ops': len(promises),
+            'seconds': elapsed,
+            'throughput': len(promises) / max(elapsed, 1e-9),
+        }
+    finally:
+        facade.close().result()
+        facade._dispose()
+    if options.processes:
+        counts = [int(n) for n in options.processes.split(',')]
+        results['scaling'] = measureScaling(plugin, filename, kwargs,
+                                            channels, replay, counts)
+    if options.memory:
+        results['memory'] = measureMemory(rng, plugin.matcher, options.memory,
+                                          options.channels, shapes)
+    return results
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--patterns', type=int, default=2000,
+                        help='patterns per channel')
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='generated messages per channel')
+    parser.add_argument('--lookups', type=int, default=500,
+                        help='getReactions calls per channel')
+    parser.add_argument('--shapes', default='word=40,phrase=20,regex=20,'
+                        'anchored=10,alternation=5,unindexed=5',
+                        help='pattern shapes and their weights, from: %s' %
+                        ', '.join(sorted(SHAPES)))
+    parser.add_argument('--corpus', help='file of messages, one per line, '
+                        'replayed in every channel instead of generated ones')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument('--processes', default='',
+                        help='numbers of processes to compare for the '
+                        'scaling benchmark, such as 1,2,4')
+    parser.add_argument('--memory', type=int, default=0,
+                        help='reactions to load for the memory benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON here, not stdout')
+    options = parser.parse_args(args)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    if options.corpus:
+        options.corpus = os.path.abspath(options.corpus)
+    options.directory = tempfile.mkdtemp(prefix='whatis-bench-')
+    # supybot writes to the directory as it shuts down at exit, so it is
+    # removed once that is done: exit functions run last to first.
+    atexit.register(shutil.rmtree, options.directory, True)
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    # supybot creates its conf, log and data directories in the current
+    # directory as soon as it is imported, and logs to stdout, which is
+    # where the results go.
+    os.chdir(options.directory)
+    sys.stdout = sys.stderr
+    try:
+        import supybot.conf as conf
+        conf.supybot.directories.data.setValue(options.directory)
+        sys.path.insert(0, here)
+        import plugin
+        results = run(options, plugin)
+    finally:
+        sys.stdout = stdout
+        os.chdir(cwd)
+        # Its log files are in the directory, which is going away.
+        logger = logging.getLogger('supybot')
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+
+    config = dict(vars(options))
+    del config['directory']
+    report = json.dumps({
+        'python': sys.version.split()[0],
+        'config': config,
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(report + '\n')
+        finally:
+            f.close()
+    else:
+        sys.stdout.write(report + '\n')
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
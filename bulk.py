@@ -0,0 +1,202 @@
+###
+# Copyright (c) 2009-2014, Torrie Fischer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Streams a Whatis channel database's Reactions table to and from JSON Lines
+(one object per line) or CSV (with a header row) files.
+
+This module doesn't need supybot, so it can also be run on its own:
+
+    python bulk.py export DATABASE FILE [CHANNEL]
+    python bulk.py import DATABASE FILE [CHANNEL]
+
+DATABASE is a channel's Whatis.sqlite3.db file, which the bot creates the
+first time it sees the channel.  When the bot keeps every channel in one
+file (supybot.plugins.Whatis.databases.singleFile), DATABASE is that file
+and CHANNEL, in lower case, says which channel's reactions to use.  FILE is
+CSV if its name ends in .csv and JSON Lines otherwise.  A running bot only
+sees rows imported this way once the plugin is reloaded; use the importfile
+command to avoid that.
+"""
+
+import sys
+import csv
+import json
+import time
+
+try:
+    from . import matcher
+except (ImportError, ValueError):
+    # Run or imported on its own, outside the plugin package.
+    import matcher
+
+COLUMNS = ('pattern', 'reaction', 'person', 'frequency')
+
+# The oldest Reactions table importReactions() can fill in.
+SCHEMA = 3
+
+def derivedBy(db):
+    """Returns the matcher.DERIVED_BY of the Python which worked out the
+    derived columns of db's Reactions table, or None if that isn't known."""
+    if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA:
+        return None
+    row = db.execute("SELECT value FROM Meta WHERE name = 'derivedBy'").fetchone()
+    return row and row[0]
+
+def formatFor(filename):
+    if filename.lower().endswith('.csv'):
+        return 'csv'
+    return 'jsonl'
+
+def openFile(filename, mode):
+    """Opens filename the way the csv module wants it on this Python."""
+    if sys.version_info[0] < 3:
+        return open(filename, mode + 'b')
+    return open(filename, mode, newline='')
+
+def _text(value):
+    if isinstance(value, bytes) and sys.version_info[0] < 3:
+        return value.decode('utf-8', 'replace')
+    return value
+
+def exportReactions(db, out, format='jsonl', channel=None, chunkSize=1000):
+    """Writes every row of db's Reactions table, or only channel's if given,
+    to the file out, fetching chunkSize rows at a time.  Returns the number
+    of rows written."""
+    if channel is None:
+        c = db.execute("SELECT pattern, reaction, person, frequency FROM Reactions")
+    else:
+        c = db.execute("SELECT pattern, reaction, person, frequency FROM Reactions WHERE channel = ?", (channel,))
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(COLUMNS)
+        write = writer.writerow
+    else:
+        def write(row):
+            out.write(json.dumps(dict(zip(COLUMNS, map(_text, row)))))
+            out.write('\n')
+    count = 0
+    while True:
+        rows = c.fetchmany(chunkSize)
+        if not rows:
+            return count
+        for row in rows:
+            write(row)
+        count += len(rows)
+
+def readReactions(f, format='jsonl'):
+    """Yields (pattern, reaction, person, frequency) tuples read from the file
+    f.  person defaults to "instinct" and frequency to 1."""
+    if format == 'csv':
+        records = csv.DictReader(f)
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+    for record in records:
+        frequency = record.get('frequency')
+        if frequency is None or frequency == '':
+            frequency = 1
+        yield (record['pattern'], record['reaction'],
+               record.get('person') or 'instinct', float(frequency))
+
+def importReactions(db, rows, channel=None, chunkSize=1000):
+    """Inserts rows into db's Reactions table, as channel's if given,
+    committing every chunkSize rows.  Rows already in the table (by pattern
+    and reaction) are skipped.  Returns the number of rows read and the
+    number inserted.  If the rest of the table was analyzed by another
+    Python, the bot analyzes all of it again the next time it opens db."""
+    if derivedBy(db) not in (None, matcher.DERIVED_BY):
+        db.execute("DELETE FROM Meta WHERE name = 'derivedBy'")
+        db.commit()
+    read = inserted = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunkSize:
+            inserted += _insertChunk(db, chunk, channel)
+            read += len(chunk)
+            chunk = []
+    if chunk:
+        inserted += _insertChunk(db, chunk, channel)
+        read += len(chunk)
+    return (read, inserted)
+
+def _insertChunk(db, chunk, channel):
+    before = db.total_changes
+    columns = COLUMNS + matcher.DERIVED
+    rows = [tuple(row) + matcher.analyze(row[0]) for row in chunk]
+    if channel is not None:
+        columns = ('channel',) + columns
+        rows = [(channel,) + row for row in rows]
+    db.executemany("INSERT OR IGNORE INTO Reactions (%s) VALUES (%s)" %
+                   (', '.join(columns), ', '.join('?' * len(columns))), rows)
+    db.commit()
+    return db.total_changes - before
+
+def main(args):
+    import sqlite3
+    if len(args) not in (3, 4) or args[0] not in ('export', 'import'):
+        sys.stderr.write(__doc__)
+        return 2
+    (command, database, filename) = args[:3]
+    channel = (args[3:] or [None])[0]
+    db = sqlite3.connect(database)
+    db.text_factory = str
+    if command == 'import' and \
+            db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA:
+        sys.stderr.write('%s is missing columns this script fills in; let '
+                         'the bot open it once to upgrade it.\n' % database)
+        return 1
+    format = formatFor(filename)
+    start = time.time()
+    if command == 'export':
+        f = openFile(filename, 'w')
+        try:
+            read = exportReactions(db, f, format, channel)
+        finally:
+            f.close()
+        inserted = read
+    else:
+        f = openFile(filename, 'r')
+        try:
+            (read, inserted) = importReactions(db, readReactions(f, format),
+                                               channel)
+        finally:
+            f.close()
+    elapsed = max(time.time() - start, 1e-6)
+    db.close()
+    sys.stdout.write('%sed %i of %i rows in %.2fs (%.0f rows/s)\n' %
+                     (command.capitalize(), inserted, read, elapsed,
+                      read / elapsed))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -45,7 +45,14 @@ Whatis = conf.registerPlugin('Whatis')
 # conf.registerGlobalValue(Whatis, 'someConfigVariableName',
 #     registry.Boolean(False, """Help for someConfigVariableName."""))
 conf.registerChannelValue(Whatis, 'autoreply',
-    registry.Boolean(False, """Automatically reply to text"""))
+    registry.Boolean(False, """Unused, and kept so configuration files
+    which mention it still load. It was never read, so existing bots have
+    it saved as False while replying anyway; automaticReplies took its
+    place."""))
+
+conf.registerChannelValue(Whatis, 'automaticReplies',
+    registry.Boolean(True, """Determines whether the bot replies to lines
+    matching a pattern it knows without being addressed."""))
 
 conf.registerChannelValue(Whatis, 'autolearn',
     registry.Boolean(False, """Automatically learn definitions"""))
@@ -53,5 +60,97 @@ conf.registerChannelValue(Whatis, 'autolearn',
 conf.registerChannelValue(Whatis, 'rate',
     registry.Integer(30, """Minimum time in seconds between automatic replies"""))
 
+conf.registerChannelValue(Whatis, 'burst',
+    registry.PositiveInteger(1, """Number of automatic replies allowed in
+    quick succession before replies are limited to one every rate
+    seconds"""))
+
+conf.registerGlobalValue(Whatis, 'maxQueue',
+    registry.NonNegativeInteger(50, """Number of jobs waiting for a channel's
+    database thread past which lines in that channel are no longer looked
+    up for automatic replies. 0 means never skip lookups."""))
+
+conf.registerGlobalValue(Whatis, 'workers',
+    registry.PositiveInteger(4, """Number of database threads. Each channel
+    is always handled by the same thread, so a slow channel only delays the
+    channels sharing its thread. Takes effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Whatis, 'processes',
+    registry.NonNegativeInteger(0, """Number of processes the databases are
+    run in, instead of in the bot's own database threads. Each channel is
+    always handled by the same process, which opens its database and
+    matches its lines, so matching in many channels can use as many CPU
+    cores. 0 runs them in threads of the bot's process, as many as workers
+    says. Needs a platform which can fork. Takes effect when the plugin is
+    reloaded."""))
+
+conf.registerGroup(Whatis, 'writes')
+conf.registerGlobalValue(Whatis.writes, 'batchSize',
+    registry.PositiveInteger(100, """Number of learned or forgotten
+    reactions a channel may have waiting before they are committed to disk
+    together. Takes effect when the plugin is reloaded."""))
+conf.registerGlobalValue(Whatis.writes, 'batchInterval',
+    registry.NonNegativeInteger(5, """Maximum number of seconds learned or
+    forgotten reactions may wait before they are committed to disk. A crash
+    loses at most this many seconds, or batchSize reactions, of learning.
+    Takes effect when the plugin is reloaded."""))
+
+conf.registerChannelValue(Whatis, 'markov',
+    registry.String('markov', """Command which <markov> reactions are passed
+    to, and whose reply is said instead."""))
+
+conf.registerGlobalValue(Whatis, 'markovTimeout',
+    registry.PositiveFloat(5.0, """Number of seconds the command of a
+    <markov> reaction has to reply before its reply is dropped."""))
+
+conf.registerGroup(Whatis, 'databases')
+conf.registerGlobalValue(Whatis.databases, 'maxOpen',
+    registry.PositiveInteger(32, """Number of database files each database
+    thread keeps open. Opening another one closes the least recently used
+    one. Takes effect when the plugin is reloaded."""))
+conf.registerGlobalValue(Whatis.databases, 'idleTimeout',
+    registry.NonNegativeInteger(600, """Number of seconds after which a
+    database file nobody used is closed. 0 keeps files open until maxOpen
+    of them are. Takes effect when the plugin is reloaded."""))
+conf.registerGlobalValue(Whatis.databases, 'singleFile',
+    registry.Boolean(False, """Determines whether every channel's
+    reactions are kept in a single Whatis.sqlite3.db file in the data
+    directory, instead of one file per channel. All channels are then
+    handled by a single database thread or process, whatever workers and
+    processes say. Existing per-channel files are not moved into it; use
+    exportfile and importfile for that. Takes effect when the plugin is
+    reloaded."""))
+
+conf.registerGlobalValue(Whatis, 'statsInterval',
+    registry.NonNegativeInteger(0, """Number of seconds between logging the
+    timings shown by the stats command. 0 disables logging them. Takes
+    effect when the plugin is reloaded."""))
+
+conf.registerGlobalValue(Whatis, 'matchBudget',
+    registry.Float(0.1, """Number of seconds of CPU time a pattern may
+    take to search a line. A pattern which takes longer three times, or
+    once if it looks like it could backtrack catastrophically, is
+    quarantined and no longer tried; see the quarantined command. 0
+    disables the limit, and quarantines the latter patterns as soon as
+    they are loaded instead. Takes effect when the plugin is reloaded."""))
+
+conf.registerChannelValue(Whatis, 'suggestionDistance',
+    registry.NonNegativeInteger(2, """Number of edits (characters inserted,
+    removed or changed) a known pattern may be away from one explain or
+    forget can't find, for it to be suggested instead. Patterns shorter than
+    three characters per edit are allowed fewer edits. 0 disables
+    suggestions."""))
+
+conf.registerGroup(Whatis, 'cache')
+conf.registerGlobalValue(Whatis.cache, 'size',
+    registry.NonNegativeInteger(256, """Number of recently seen lines per
+    channel whose matching patterns are remembered, so repeated lines don't
+    have to be matched again. 0 disables the cache. Takes effect when the
+    plugin is reloaded."""))
+conf.registerGlobalValue(Whatis.cache, 'ttl',
+    registry.PositiveInteger(300, """Number of seconds the matching
+    patterns of a line are remembered. Takes effect when the plugin is
+    reloaded."""))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
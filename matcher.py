@@ -0,0 +1,848 @@
+###
+# Copyright (c) 2009-2014, Torrie Fischer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+import re
+import sys
+import time
+import random
+import bisect
+import hashlib
+import logging
+import sre_parse
+import sre_constants
+from collections import OrderedDict
+
+try:
+    from . import timing
+except (ImportError, ValueError):
+    # Run or imported on its own, outside the plugin package.
+    import timing
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    # Only the time the searching thread itself spends, so a slow search
+    # on another thread, which holds the GIL meanwhile, isn't counted.
+    searchClock = time.thread_time
+except AttributeError:
+    searchClock = getattr(time, 'perf_counter', time.time)
+
+def _factors(subpattern, char):
+    """Returns a list of key sets for a parsed (sub)pattern.  Any text the
+    subpattern matches contains at least one key out of every set."""
+    factors = []
+    run = []
+    def flush():
+        if run:
+            factors.append(frozenset([''.join(run)]))
+            del run[:]
+    for (op, av) in subpattern:
+        if op == sre_constants.LITERAL:
+            run.append(char(av))
+        elif op == sre_constants.AT:
+            # Zero-width, so the literals on either side stay adjacent.
+            continue
+        else:
+            flush()
+            if op == sre_constants.SUBPATTERN:
+                if len(av) == 4 and av[1] & re.IGNORECASE:
+                    continue
+                factors.extend(_factors(av[-1], char))
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                (low, high, item) = av
+                if low >= 1:
+                    factors.extend(_factors(item, char))
+            elif op == sre_constants.BRANCH:
+                alternatives = []
+                for branch in av[1]:
+                    best = _bestFactor(_factors(branch, char))
+                    if best is None:
+                        break
+                    alternatives.extend(best)
+                else:
+                    factors.append(frozenset(alternatives))
+    flush()
+    return factors
+
+def _bestFactor(factors):
+    if not factors:
+        return None
+    return max(factors, key=lambda keys: (min(map(len, keys)), -len(keys)))
+
+def lower(s):
+    """Returns s lower-cased one character at a time.  str.lower() turns a
+    capital sigma ending a word into a final sigma, which the same letter
+    on its own doesn't become, so a key and the text it appears in could
+    be lowered differently."""
+    if isinstance(s, type(u'')) and u'\u03a3' in s:
+        return u''.join([c.lower() for c in s])
+    return s.lower()
+
+def literalKeys(pattern):
+    """Returns a set of lower-cased literal strings, at least one of which
+    appears (lower-cased) in any text the pattern can match, or None if no
+    such set could be worked out."""
+    if isinstance(pattern, type(u'')):
+        char = unichr
+    else:
+        char = chr
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern')
+    if state.flags & re.IGNORECASE and \
+            (state.flags & re.UNICODE or char is not chr):
+        # Unicode case folding can match characters lower() won't produce.
+        return None
+    keys = _bestFactor(_factors(parsed, char))
+    if keys is None:
+        return None
+    return frozenset([lower(key) for key in keys])
+
+def _overlaps(branches):
+    """Returns whether two of the alternatives could start matching the same
+    text.  sre_parse moves common prefixes out of a branch, so (a|aa) shows
+    up as a(|a), with an empty alternative.  Only alternatives starting with
+    distinct literals are known not to overlap; anything else, such as a
+    class, a dot or an optional repeat, is assumed to."""
+    starts = set()
+    for branch in branches:
+        if not branch:
+            return True
+        (op, av) = branch[0]
+        if op != sre_constants.LITERAL or av in starts:
+            return True
+        starts.add(av)
+    return False
+
+def _risk(subpattern, repeated):
+    for (op, av) in subpattern:
+        risk = None
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            (low, high, item) = av
+            if high > 1 and low != high:
+                if repeated:
+                    return 'nested quantifiers'
+                risk = _risk(item, True)
+            else:
+                risk = _risk(item, repeated)
+        elif op == sre_constants.SUBPATTERN:
+            risk = _risk(av[-1], repeated)
+        elif op == sre_constants.BRANCH:
+            if repeated and _overlaps(av[1]):
+                return 'repeated alternatives which overlap'
+            for branch in av[1]:
+                risk = risk or _risk(branch, repeated)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            risk = _risk(av[1], repeated)
+        if risk:
+            return risk
+    return None
+
+def backtrackingRisk(pattern):
+    """Returns why pattern could take exponential time to fail to match,
+    such as the nested quantifiers of (a+)+$, or None if it looks safe.
+    This errs on the side of caution: some of the patterns it reports would
+    in fact match quickly."""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    return _risk(parsed, False)
+
+def isLiteral(pattern):
+    """Returns whether pattern matches one fixed text and nothing else."""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return False
+    state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern')
+    if state.flags & re.IGNORECASE:
+        return False
+    return all([op == sre_constants.LITERAL for (op, av) in parsed])
+
+def literalText(pattern):
+    """Returns the text a pattern for which isLiteral() is true matches."""
+    if '\\' not in pattern and '[' not in pattern and '(' not in pattern:
+        # Escapes, classes and groups, such as inline flags and comments,
+        # are the only ways a literal pattern can differ from its text.
+        return pattern
+    if isinstance(pattern, type(u'')):
+        char = unichr
+    else:
+        char = chr
+    return pattern[:0].join([char(av)
+                             for (op, av) in sre_parse.parse(pattern)])
+
+def patternHash(pattern):
+    """Returns a 60 bit hash of pattern, which fits an SQLite INTEGER."""
+    if isinstance(pattern, type(u'')):
+        pattern = pattern.encode('utf-8')
+    return int(hashlib.sha1(pattern).hexdigest()[:15], 16)
+
+# The columns analyze() fills in, in order.
+DERIVED = ('literal', 'keywords', 'valid', 'risk', 'patternHash')
+
+# What they were worked out by: re and sre_parse differ between versions
+# of Python.  The number goes up when analyze() itself changes.
+DERIVED_BY = 'Python %i.%i, analyze 2' % sys.version_info[:2]
+
+def analyze(pattern):
+    """Returns what is worth knowing about pattern before matching it, in the
+    order of DERIVED: whether it is literal, its literal keys joined by
+    newlines (None if it has none), whether it compiles, its
+    backtrackingRisk() and its patternHash()."""
+    try:
+        re.compile(pattern)
+    except re.error:
+        return (False, None, False, None, patternHash(pattern))
+    keys = literalKeys(pattern)
+    if keys and not [key for key in keys if '\n' in key]:
+        keywords = '\n'.join(sorted(keys))
+    else:
+        keywords = None
+    return (isLiteral(pattern), keywords, True, backtrackingRisk(pattern),
+            patternHash(pattern))
+
+class LiteralIndex(object):
+    """Aho-Corasick automaton mapping literal keys to the values which
+    were added under them.
+
+    Building the automaton takes time in proportion to all the keys, so it
+    isn't rebuilt for every change.  Keys added since it was built are
+    looked for with a substring test each, and keys removed since are left
+    in it, and their matches dropped.  Once there are more of either than
+    SLACK, or an eighth of the keys, the next search rebuilds it.
+
+    Most states have a single transition, so rather than a dict per state
+    the transitions all live in one dict, keyed by state | ord(ch).  States
+    are numbered in steps of SHIFT, which leaves room below them for any
+    code point.
+    """
+    SHIFT = 21
+    SLACK = 32
+
+    def __init__(self):
+        self.keys = {}
+        self.pending = set()
+        self.stale = 0
+        self._goto = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, value):
+        values = self.keys.get(key)
+        if values is None:
+            self.keys[key] = (value,)
+            if self._goto is not None:
+                self.pending.add(key)
+        elif value not in values:
+            self.keys[key] = values + (value,)
+
+    def discard(self, key, value):
+        values = self.keys.get(key)
+        if values is not None and value in values:
+            values = tuple([v for v in values if v != value])
+            if values:
+                self.keys[key] = values
+            else:
+                del self.keys[key]
+                if key in self.pending:
+                    self.pending.discard(key)
+                elif self._goto is not None:
+                    self.stale += 1
+
+    def _build(self):
+        shift = self.SHIFT
+        goto = {}
+        children = [[]]
+        out = [()]
+        for key in self.keys:
+            state = 0
+            for c in map(ord, key):
+                next = goto.get(state | c)
+                if next is None:
+                    next = len(out) << shift
+                    goto[state | c] = next
+                    children[state >> shift].append(c)
+                    children.append([])
+                    out.append(())
+                state = next
+            out[state >> shift] = (key,)
+        fail = [0] * len(out)
+        queue = [goto[c] for c in children[0]]
+        for state in queue:
+            for c in children[state >> shift]:
+                next = goto[state | c]
+                queue.append(next)
+                f = fail[state >> shift]
+                while f and (f | c) not in goto:
+                    f = fail[f >> shift]
+                f = goto.get(f | c, 0)
+                fail[next >> shift] = f
+                if out[f >> shift]:
+                    out[next >> shift] = out[next >> shift] + out[f >> shift]
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self.pending = set()
+        self.stale = 0
+
+    def search(self, text):
+        """Returns the set of values whose keys occur in text."""
+        if self._goto is None or len(self.pending) + self.stale > \
+                max(self.SLACK, len(self.keys) // 8):
+            self._build()
+        shift = self.SHIFT
+        get = self._goto.get
+        fail = self._fail
+        out = self._out
+        found = set()
+        state = 0
+        for c in map(ord, text):
+            next = get(state | c)
+            while next is None and state:
+                state = fail[state >> shift]
+                next = get(state | c)
+            state = next or 0
+            keys = out[state >> shift]
+            if keys:
+                found.update(keys)
+        for key in self.pending:
+            if key in text:
+                found.add(key)
+        values = set()
+        for key in found:
+            values.update(self.keys.get(key, ()))
+        return values
+
+def editDistance(a, b, limit):
+    """Returns the Levenshtein distance between a and b, or limit + 1 if it
+    is more than limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for (i, x) in enumerate(a):
+        current = [i + 1]
+        for (j, y) in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1,
+                               previous[j] + (x != y)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+class SimilarityIndex(object):
+    """Trigram index of strings, for finding the ones within a few edits of
+    some text without comparing it to all of them.  Comparisons ignore
+    case.
+
+    An edit changes at most Q of a string's trigrams, so a string d edits
+    away from text shares all but d * Q of text's trigrams with it.  Only
+    strings sharing enough of them (and at least one) are compared to text,
+    those sharing the most first, and only until no remaining one can be
+    as near as the nearest found.  Texts are allowed at most one edit per
+    three characters, as a short text a few edits away from a string has
+    little to do with it, and shares too few trigrams with it to narrow
+    down the strings to compare."""
+    Q = 3
+
+    def __init__(self, strings=()):
+        self.grams = {}
+        for s in strings:
+            self.add(s)
+
+    def __len__(self):
+        return len(self.grams)
+
+    def _grams(self, s):
+        padded = '\0' * (self.Q - 1) + s.lower() + '\0' * (self.Q - 1)
+        return set([padded[i:i + self.Q]
+                    for i in range(len(padded) - self.Q + 1)])
+
+    def add(self, s):
+        for gram in self._grams(s):
+            self.grams.setdefault(gram, set()).add(s)
+
+    def discard(self, s):
+        for gram in self._grams(s):
+            strings = self.grams.get(gram)
+            if strings is not None:
+                strings.discard(s)
+                if not strings:
+                    del self.grams[gram]
+
+    def similar(self, text, distance, limit=3):
+        """Returns the strings nearest to text, if they are within distance
+        edits of it, and at most limit of them."""
+        q = self.Q
+        distance = min(distance, len(text) // 3)
+        postings = sorted([self.grams.get(gram, ()) for gram in
+                           self._grams(text)], key=len)
+        need = max(1, len(postings) - distance * q)
+        # A string sharing need trigrams with text shares at least one of
+        # its rarest len(postings) - need + 1, so only those are counted.
+        rare = len(postings) - need + 1
+        counts = {}
+        for strings in postings[:rare]:
+            for s in strings:
+                counts[s] = counts.get(s, 0) + 1
+        candidates = []
+        for (s, count) in counts.items():
+            if abs(len(s) - len(text)) > distance:
+                continue
+            for strings in postings[rare:]:
+                if s in strings:
+                    count += 1
+            if count >= need:
+                candidates.append((-count, s))
+        candidates.sort()
+        text = text.lower()
+        found = []
+        for (count, s) in candidates:
+            # The fewest edits which could leave only this many in common.
+            if (len(postings) + count + q - 1) // q > distance:
+                break
+            d = editDistance(text, s.lower(), distance)
+            if d < distance:
+                distance = d
+                found = []
+            if d == distance:
+                found.append(s)
+        return sorted(found)[:limit]
+
+class WeightedChoice(object):
+    """Picks items with probability proportional to their weights, using a
+    cumulative weight array and a binary search.  Weights which aren't
+    positive are never picked."""
+    def __init__(self, items, weights):
+        self.items = []
+        self.totals = []
+        total = 0.0
+        for (item, weight) in zip(items, weights):
+            if weight > 0:
+                total += weight
+                self.items.append(item)
+                self.totals.append(total)
+        self.total = total
+
+    def __len__(self):
+        return len(self.items)
+
+    def choose(self, rng=random):
+        if not self.items:
+            return None
+        i = bisect.bisect_right(self.totals, rng.random() * self.total)
+        return self.items[min(i, len(self.items) - 1)]
+
+class ResultCache(object):
+    """Least recently used cache of at most size entries, which also expire
+    ttl seconds after they are stored."""
+    def __init__(self, size=256, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def items(self):
+        return [(key, entry[1]) for (key, entry) in self.entries.items()]
+
+    def replace(self, key, value):
+        """Changes the value of an entry without refreshing it."""
+        if key in self.entries:
+            self.entries[key] = (self.entries[key][0], value)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+class Template(object):
+    """A reaction's text, parsed once.  tag is "action", "reply", "markov"
+    or None, and the text is split around its $nick, $who and $channel
+    variables.  Untagged reactions (and unknown tags) render as "<pattern>
+    is <reaction>", without any variables."""
+    __slots__ = ('tag', 'segments', 'slots')
+    TAGS = ('action', 'reply', 'markov')
+    VARIABLES = re.compile(r'\$(nick|who|channel)')
+
+    def __init__(self, pattern, reaction):
+        self.tag = None
+        match = re.match('(<.+>)?(.+)', reaction)
+        if match and match.group(1) is not None:
+            self.tag = match.group(1)[1:-1]
+        if self.tag in self.TAGS:
+            self.segments = self.VARIABLES.split(match.group(2))
+        else:
+            self.tag = None
+            self.segments = ['%s is %s' % (pattern, reaction)]
+        self.slots = [(i, self.segments[i])
+                      for i in range(1, len(self.segments), 2)]
+
+    def render(self, variables):
+        """Returns the text with its variables taken from the dict
+        variables."""
+        if not self.slots:
+            return self.segments[0]
+        segments = list(self.segments)
+        for (i, name) in self.slots:
+            segments[i] = variables[name]
+        return ''.join(segments)
+
+class Reaction(object):
+    """One row of the Reactions table, as kept in memory.  Reactions are
+    read like the dicts they replace (reaction['person'], '%(reaction)s' %
+    reaction), but have no __dict__ of their own, and their Template is only
+    parsed the first time it's asked for.
+
+    The matcher hands out the Reactions it keeps, so treat them as
+    read-only."""
+    __slots__ = ('pattern', 'reaction', 'person', 'frequency', '_template')
+    FIELDS = ('reaction', 'pattern', 'person', 'frequency', 'template')
+
+    def __init__(self, pattern, reaction, person, frequency):
+        self.pattern = pattern
+        self.reaction = reaction
+        self.person = person
+        self.frequency = frequency
+
+    @property
+    def template(self):
+        try:
+            return self._template
+        except AttributeError:
+            self._template = Template(self.pattern, self.reaction)
+            return self._template
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, Reaction):
+            return NotImplemented
+        return (self.pattern, self.reaction, self.person, self.frequency) == \
+               (other.pattern, other.reaction, other.person, other.frequency)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Reaction(%r, %r, %r, %r)' % (self.pattern, self.reaction,
+                                             self.person, self.frequency)
+
+class ChannelMatcher(object):
+    """In-memory, precompiled copy of one channel's Reactions table.
+
+    Patterns are compiled once when they are loaded or learned, so finding
+    the reactions for a line of text never has to go back to the database.
+    Patterns with literal keys are only tried when one of their keys shows
+    up in the text; the rest are tried against every line.  Literal
+    patterns aren't compiled at all, a substring test is enough for them.
+    The patterns matching recently seen lines are cached, and the cache is
+    kept exact as patterns come and go.  Reactions are kept as Reaction
+    records, and reactions to the same pattern, or by the same person,
+    share one copy of the string.  The patterns are only put in a
+    SimilarityIndex once something asks for patterns like some text.
+
+    Patterns which took longer than budget seconds to search a line
+    STRIKES times are quarantined: they are kept, but no longer tried.
+    Patterns which could backtrack catastrophically are quarantined the
+    first time they do, or straight away if there is no budget.  A search
+    can't be interrupted, so a slow pattern still stalls the lines that
+    catch it, but only a few times.
+    """
+    STRIKES = 3
+
+    def __init__(self, rows=(), cacheSize=256, cacheTtl=300, budget=0):
+        self.cache = ResultCache(cacheSize, cacheTtl)
+        self.budget = budget
+        self.quarantined = {}
+        self.suspects = set()
+        self.overruns = {}
+        self.compiled = {}
+        self.literals = {}
+        self.reactions = {}
+        self.persons = {}
+        self.keys = {}
+        self.samplers = {}
+        self.index = LiteralIndex()
+        self.similar = None
+        self.unindexed = set()
+        self.lookups = 0
+        self.scanned = 0
+        self.matched = 0
+        self.timing = timing.Histogram()
+        for row in rows:
+            self.add(*row, loading=True)
+        if self.quarantined:
+            logging.warning("Quarantined %i patterns which could backtrack "
+                            "catastrophically, such as %r.",
+                            len(self.quarantined), min(self.quarantined))
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def add(self, pattern, reaction, person, frequency, derived=None,
+            loading=False):
+        """Adds a reaction to pattern.  derived is what analyze() returns
+        for pattern, if it is already known."""
+        reactions = self.reactions.get(pattern)
+        if reactions:
+            # Every reaction to a pattern shares one copy of it.
+            pattern = reactions[0].pattern
+        if pattern not in self.compiled:
+            if derived is None:
+                derived = analyze(pattern)
+            (literal, keywords, valid, risk, hash) = derived
+            if not valid:
+                logging.warning("Ignoring uncompilable pattern %r", pattern)
+                return False
+            try:
+                if literal:
+                    text = literalText(pattern)
+                else:
+                    self.compiled[pattern] = re.compile(pattern)
+            except re.error:
+                # derived may have been worked out by another version of
+                # Python, whose re accepts more patterns.
+                logging.warning("Ignoring uncompilable pattern %r", pattern)
+                return False
+            if literal:
+                self.compiled[pattern] = None
+                self.literals[pattern] = text
+            if risk and self.budget > 0:
+                self.suspects.add(pattern)
+                self._index(pattern, keywords)
+            elif risk:
+                # Logged once for all of them when loading.
+                self.quarantine(pattern, risk, log=not loading)
+            else:
+                self._index(pattern, keywords)
+            if self.similar is not None:
+                self.similar.add(pattern)
+        person = self.persons.setdefault(person, person)
+        record = Reaction(pattern, reaction, person, frequency)
+        reactions = self.reactions.setdefault(pattern, [])
+        for (i, r) in enumerate(reactions):
+            if r.reaction == reaction:
+                reactions[i] = record
+                break
+        else:
+            reactions.append(record)
+        self.samplers.pop(pattern, None)
+        return True
+
+    def remove(self, pattern, reaction):
+        reactions = self.reactions.get(pattern)
+        if reactions is None:
+            return False
+        for (i, r) in enumerate(reactions):
+            if r.reaction == reaction:
+                del reactions[i]
+                break
+        else:
+            return False
+        self.samplers.pop(pattern, None)
+        if not reactions:
+            del self.reactions[pattern]
+            if self.quarantined.pop(pattern, None) is None:
+                self._unindex(pattern)
+            self.suspects.discard(pattern)
+            self.overruns.pop(pattern, None)
+            del self.compiled[pattern]
+            self.literals.pop(pattern, None)
+            if self.similar is not None:
+                self.similar.discard(pattern)
+        return True
+
+    def _search(self, pattern, text):
+        literal = self.literals.get(pattern)
+        if literal is not None:
+            return literal in text
+        return self.compiled[pattern].search(text) is not None
+
+    def _index(self, pattern, keywords):
+        for (text, patterns) in self.cache.items():
+            if self._search(pattern, text):
+                self.cache.replace(text, patterns | frozenset([pattern]))
+        if keywords:
+            keys = tuple(keywords.split('\n'))
+            self.keys[pattern] = keys
+            for key in keys:
+                self.index.add(key, pattern)
+        else:
+            self.unindexed.add(pattern)
+
+    def _unindex(self, pattern):
+        for key in self.keys.pop(pattern, ()):
+            self.index.discard(key, pattern)
+        self.unindexed.discard(pattern)
+        for (text, patterns) in self.cache.items():
+            if pattern in patterns:
+                self.cache.replace(text, patterns - frozenset([pattern]))
+
+    def quarantine(self, pattern, reason, log=True):
+        """Stops trying pattern, for the given reason."""
+        if pattern not in self.compiled or pattern in self.quarantined:
+            return
+        if log:
+            logging.warning("Quarantining pattern %r: %s", pattern, reason)
+        self._unindex(pattern)
+        self.quarantined[pattern] = reason
+
+    def match(self, text):
+        """Returns the patterns which match somewhere in text."""
+        self.lookups += 1
+        matched = self.cache.get(text)
+        if matched is None:
+            start = time.time()
+            candidates = self.index.search(lower(text))
+            candidates.update(self.unindexed)
+            compiled = self.compiled
+            literals = self.literals
+            budget = self.budget
+            found = []
+            for pattern in candidates:
+                literal = literals.get(pattern)
+                if literal is not None:
+                    if literal in text:
+                        found.append(pattern)
+                    continue
+                began = searchClock()
+                if compiled[pattern].search(text) is not None:
+                    found.append(pattern)
+                elapsed = searchClock() - began
+                if budget > 0 and elapsed > budget and \
+                        self._overran(pattern, elapsed, text):
+                    if found and found[-1] == pattern:
+                        found.pop()
+            matched = frozenset(found)
+            self.cache.put(text, matched)
+            self.timing.add(time.time() - start)
+            self.scanned += len(candidates)
+            self.matched += len(matched)
+        return list(matched)
+
+    def _overran(self, pattern, elapsed, text):
+        """Counts a search of text by pattern which went over budget, and
+        returns whether that got pattern quarantined."""
+        count = self.overruns.get(pattern, 0) + 1
+        self.overruns[pattern] = count
+        if count < self.STRIKES and pattern not in self.suspects:
+            return False
+        if len(text) > 40:
+            text = text[:40] + '...'
+        self.quarantine(pattern, 'took %.0fms to search %r' %
+                        (elapsed * 1000, text))
+        return True
+
+    def stats(self):
+        return {
+            'patterns': len(self.compiled),
+            'indexed': len(self.keys),
+            'literal': len(self.literals),
+            'quarantined': len(self.quarantined),
+            'lookups': self.lookups,
+            'cached': self.cache.hits,
+            'scanned': self.scanned,
+            'matched': self.matched,
+            'timing': self.timing.summary()
+        }
+
+    def suggest(self, text, distance, limit=3):
+        """Returns the patterns nearest to text, if they are within distance
+        edits of it, and at most limit of them."""
+        if self.similar is None:
+            self.similar = SimilarityIndex(self.compiled)
+        return self.similar.similar(text, distance, limit)
+
+    def _getSampler(self, pattern):
+        sampler = self.samplers.get(pattern)
+        if sampler is None:
+            reactions = self.reactions.get(pattern, ())
+            sampler = WeightedChoice(reactions,
+                    [r.frequency or 0 for r in reactions])
+            self.samplers[pattern] = sampler
+        return sampler
+
+    def choose(self, patterns, rng=random):
+        """Picks one reaction belonging to any of the given patterns, with
+        probability proportional to its frequency.  The Reaction returned
+        is the matcher's own."""
+        samplers = [self._getSampler(p) for p in patterns]
+        sampler = WeightedChoice(samplers, [s.total for s in samplers])
+        if not sampler:
+            return None
+        return sampler.choose(rng).choose(rng)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -27,6 +27,7 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 ###
+import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
 from supybot.commands import *
@@ -41,200 +42,939 @@ import re
 import sqlite3
 
 import functools
-import Queue
+from collections import OrderedDict
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 import threading
 import logging
+import signal
+import multiprocessing
+import os
+import stat
 
-class QuietNestedCommandsIrcProxy(callbacks.NestedCommandsIrcProxy):
-    def __init__(self, *args, **kwargs):
-        self.savedReply = None
-        super(QuietNestedCommandsIrcProxy, self).__init__(*args, **kwargs)
+try:
+    from . import bulk, timing, matcher
+except (ImportError, ValueError):
+    # Imported on its own, as bench.py does.
+    import bulk, timing, matcher
 
-    def getCommandHelp(self, command, simpleSyntax=None):
-        return ""
+try:
+    basestring
+except NameError:
+    basestring = str
 
-    def reply(self, s, msg=None, **kwargs):
-        if msg is None:
-            msg = self.msg
-        self.savedReply = s
-        self.noReply()
+try:
+    # Worker processes get the wrapped class without pickling it, by forking.
+    forking = multiprocessing.get_context('fork')
+except AttributeError:
+    # Python 2 always forks.
+    forking = multiprocessing
+except ValueError:
+    forking = None
 
-    def replyError(self, *args, **kwargs):
-        self.noReply()
+class CapturedReplyIrc(object):
+    """Stands in for irc when a command is called directly: its first reply
+    is handed to deliver if it comes before deadline, and everything else
+    the command says is dropped."""
+    def __init__(self, irc, msg, deliver, deadline):
+        self.irc = irc
+        self.msg = msg
+        self.deliver = deliver
+        self.deadline = deadline
+        self.replied = False
 
-    def replySucces(self, *args, **kwargs):
-        self.noReply()
+    def reply(self, s, *args, **kwargs):
+        if self.replied:
+            return
+        self.replied = True
+        if time.time() > self.deadline:
+            logging.debug("Dropping late reply %r", s)
+            return
+        self.deliver(s)
 
-    def _callCommand(self, command, irc, msg, *args, **kwargs):
-        self.log.info('%s called by %q.', callbacks.formatCommand(command), msg.prefix)
-        try:
-            for name in command:
-                cap = callbacks.checkCommandCapability(msg, self, name)
-                if cap:
-                    return
-            try:
-                self.callingCommand = command
-                self.callCommand(command, irc, msg, *args, **kwargs)
-            finally:
-                self.callingCommand = None
-        except:
-            pass
+    def __getattr__(self, name):
+        if name.startswith('reply') or name.startswith('error') or \
+                name == 'noReply':
+            return lambda *args, **kwargs: None
+        return getattr(self.irc, name)
 
 class Promise(object):
   def __init__(self):
     self.event = threading.Event()
     self.value = None
     self.exception = None
+    self.lock = threading.Lock()
+    self.callbacks = []
   
+  waits = timing.Histogram()
+
   def result(self):
-    logging.debug("Waiting to resolve promise")
-    self.event.wait()
-    logging.debug("Promise finished!")
+    if not self.event.isSet():
+      logging.debug("Waiting to resolve promise")
+      start = time.time()
+      self.event.wait()
+      Promise.waits.add(time.time() - start)
+      logging.debug("Promise finished!")
     if self.exception is not None:
         raise self.exception
     return self.value
 
+  def done(self):
+    return self.event.isSet()
+
   def finish(self, val):
     self.value = val
-    self.event.set()
+    self.__resolve()
 
   def errored(self, exc):
     self.exception = exc
-    self.event.set()
+    self.__resolve()
 
-class ThreadProtectionFacade(object):
-  def __init__(self, wrappedClass, *args, **kwargs):
+  def __resolve(self):
+    with self.lock:
+      self.event.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for callback in callbacks:
+      self.__call(callback)
 
-    def f(*args, **kwargs):
-      return wrappedClass(*args, **kwargs)
+  def __call(self, callback):
+    try:
+      callback(self)
+    except Exception:
+      logging.exception("Error in promise callback %r", callback)
+
+  def addDoneCallback(self, callback):
+    """Calls callback with this promise once it is resolved.  That happens
+    on whichever thread resolves it, or right away if it already is."""
+    with self.lock:
+      if not self.event.isSet():
+        self.callbacks.append(callback)
+        return
+    self.__call(callback)
 
-    self.__makeWrapped = f
-    self.__wrapEvent = threading.Event()
+  @classmethod
+  def fromFuture(cls, future):
+    """Returns a Promise which resolves along with future, which may be a
+    concurrent.futures or an asyncio Future.  A cancelled future errors the
+    Promise with whatever its exception() raises."""
+    promise = cls()
+    def resolved(future):
+      try:
+        exception = future.exception()
+      except Exception as e:
+        exception = e
+      if exception is not None:
+        promise.errored(exception)
+      else:
+        promise.finish(future.result())
+    future.add_done_callback(resolved)
+    return promise
 
-    self.__jobs = Queue.Queue()
-    self.__thread = threading.Thread(target=self.__objThread)
-    self.__thread.start()
+  def then(self, callback, errback=None):
+    """Returns a new Promise for callback(value), or for errback(exception)
+    if this one errored.  If either returns a Promise, the new Promise
+    resolves along with it."""
+    chained = Promise()
+    def forward(promise):
+      if promise.exception is not None:
+        chained.errored(promise.exception)
+      else:
+        chained.finish(promise.value)
+    def resolved(promise):
+      try:
+        if promise.exception is None:
+          val = callback(promise.value)
+        elif errback is not None:
+          val = errback(promise.exception)
+        else:
+          chained.errored(promise.exception)
+          return
+      except Exception as e:
+        chained.errored(e)
+        return
+      if isinstance(val, Promise):
+        val.addDoneCallback(forward)
+      else:
+        chained.finish(val)
+    self.addDoneCallback(resolved)
+    return chained
 
-  def __del__(self):
-    self._dispose()
+class _GatheredPromise(Promise):
+  """A Promise for the list of results of several other promises."""
+  def __init__(self, promises):
+    super(_GatheredPromise, self).__init__()
+    self.promises = promises
+    self.remaining = len(promises)
+    self.gatherLock = threading.Lock()
+    if not promises:
+      self.finish([])
+    for p in promises:
+      p.addDoneCallback(self.__gathered)
 
-  def _dispose(self):
-    self.__jobs.put(None)
+  def __gathered(self, promise):
+    with self.gatherLock:
+      self.remaining -= 1
+      if self.remaining:
+        return
+    for p in self.promises:
+      if p.exception is not None:
+        self.errored(p.exception)
+        return
+    self.finish([p.value for p in self.promises])
 
-  def __objThread(self):
-    self._wrapped = self.__makeWrapped()
-    self.__wrapEvent.set()
+class _FacadeShard(object):
+  def __init__(self, makeWrapped, name):
+    self.makeWrapped = makeWrapped
+    self.wrapped = None
+    self.error = None
+    self.ready = threading.Event()
+    self.jobs = Queue.Queue()
+    self.processed = 0
+    self.waited = 0.0
+    self.maxWait = 0.0
+    self.timings = {}
+    self.thread = threading.Thread(target=self.run, name=name)
+    self.thread.start()
+
+  def run(self):
+    try:
+      self.wrapped = self.makeWrapped()
+    except Exception as e:
+      logging.exception("Could not create wrapped object")
+      self.error = e
+    self.ready.set()
     while True:
-      job = self.__jobs.get()
+      job = self.jobs.get()
       if job is None:
         logging.debug("Quitting job thread")
         return
-      func, promise = job
-      logging.debug("Processing job %r", func)
+      key, args, kwargs, promise, queued = job
+      start = time.time()
+      waited = start - queued
+      self.processed += 1
+      self.waited += waited
+      self.maxWait = max(self.maxWait, waited)
+      if key not in self.timings:
+        self.timings[key] = (timing.Histogram(), timing.Histogram())
+      (waits, runs) = self.timings[key]
+      waits.add(waited)
+      logging.debug("Processing job %r", key)
       try:
-          promise.finish(func())
-      except Exception, e:
+          if self.error is not None:
+              raise self.error
+          val = getattr(self.wrapped, key)(*args, **kwargs)
+      except Exception as e:
+          runs.add(time.time() - start)
           promise.errored(e)
+      else:
+          runs.add(time.time() - start)
+          promise.finish(val)
 
-  def __schedule(self, func, *args, **kwargs):
+  def schedule(self, key, args, kwargs):
     p = Promise()
-    logging.debug("Scheduling %r", func)
-    self.__jobs.put((functools.partial(func, *args, **kwargs), p))
+    logging.debug("Scheduling %r", key)
+    self.jobs.put((key, args, kwargs, p, time.time()))
     return p
 
-  def __getattr__(self, key): 
-    self.__wrapEvent.wait()
-    val = getattr(self._wrapped, key)
-    if threading.currentThread() != self.__thread and callable(val):
+  def stats(self):
+    return {
+      'queued': self.jobs.qsize(),
+      'processed': self.processed,
+      'averageWait': self.waited / max(self.processed, 1),
+      'maxWait': self.maxWait
+    }
+
+class ThreadProtectionFacade(object):
+  """Runs every method call on the wrapped object in a worker thread and
+  returns a Promise for its result.
+
+  With more than one worker, each worker thread gets its own instance of
+  the wrapped class.  Calls are sharded on their first argument (the
+  channel), so everything for one channel is serialized on one thread,
+  while other channels carry on in parallel.  Calls with no channel go to
+  every shard.
+  """
+  def __init__(self, wrappedClass, *args, **kwargs):
+    workers = kwargs.pop('workers', 1)
+
+    def f():
+      return wrappedClass(*args, **kwargs)
+
+    self.__shards = [_FacadeShard(f, 'ThreadProtectionFacade-%i' % i)
+                     for i in range(max(workers, 1))]
+
+  def __del__(self):
+    self._dispose()
+
+  def _dispose(self):
+    for shard in self.__shards:
+      shard.jobs.put(None)
+
+  def _shardFor(self, channel):
+    return self.__shards[hash(ircutils.toLower(channel)) % len(self.__shards)]
+
+  def _queueDepth(self, channel):
+    """Returns the number of jobs waiting ahead of a call for channel."""
+    return self._shardFor(channel).jobs.qsize()
+
+  def _stats(self):
+    """Returns the queue depth and wait times of every shard."""
+    return [shard.stats() for shard in self.__shards]
+
+  def _methodStats(self):
+    """Returns the queue wait and run time Histograms of every method, summed
+    over all shards."""
+    methods = {}
+    for shard in self.__shards:
+      for (key, (waits, runs)) in list(shard.timings.items()):
+        if key not in methods:
+          methods[key] = (timing.Histogram(), timing.Histogram())
+        methods[key][0].merge(waits)
+        methods[key][1].merge(runs)
+    return methods
+
+  def __schedule(self, key, args, kwargs):
+    if args and isinstance(args[0], basestring):
+      return self._shardFor(args[0]).schedule(key, args, kwargs)
+    return _GatheredPromise([shard.schedule(key, args, kwargs)
+                             for shard in self.__shards])
+
+  def __getattr__(self, key):
+    if key.startswith('_ThreadProtectionFacade__'):
+      raise AttributeError(key)
+    shard = self.__shards[0]
+    shard.ready.wait()
+    if shard.error is not None:
+      raise shard.error
+    val = getattr(shard.wrapped, key)
+    if callable(val):
       @functools.wraps(val)
       def schedule(*args, **kwargs):
-        return self.__schedule(val, *args, **kwargs)
+        return self.__schedule(key, args, kwargs)
       return schedule
     else:
       return val
 
-def regexp(expr, item):
-    reg = re.compile(expr)
-    logging.info("Matched %r against %r to get %r", expr, item, reg)
-    return reg.search(item) is not None
+def _openSockets():
+  """Returns the file descriptors of the sockets this process has open."""
+  try:
+    fds = [int(fd) for fd in os.listdir('/dev/fd')]
+  except OSError:
+    fds = range(1024)
+  sockets = []
+  for fd in fds:
+    try:
+      if stat.S_ISSOCK(os.fstat(fd).st_mode):
+        sockets.append(fd)
+    except OSError:
+      # Such as the descriptor listdir() had open.
+      pass
+  return sockets
+
+def _closeInheritedSockets(keep):
+  """Closes the sockets a forked worker process inherited, such as the bot's
+  connections and the other workers' pipes, except those in keep.  Each is
+  replaced with /dev/null rather than closed outright, so the objects
+  which still refer to it can't close some file which reused the number."""
+  null = os.open(os.devnull, os.O_RDWR)
+  try:
+    for fd in _openSockets():
+      if fd not in keep:
+        os.dup2(null, fd)
+  finally:
+    os.close(null)
+
+def _reopenLogs():
+  """Gives a forked worker process handlers of its own, appending to the
+  files the bot logs to: the inherited ones may be locked by threads which
+  only exist in the bot's process."""
+  root = logging.getLogger()
+  bot = logging.getLogger('supybot')
+  handlers = OrderedDict()
+  for old in root.handlers + bot.handlers:
+    filename = getattr(old, 'baseFilename', None)
+    if filename is not None and filename not in handlers:
+      handler = logging.FileHandler(filename, delay=True)
+      handler.setFormatter(old.formatter)
+      handler.setLevel(old.level)
+      handlers[filename] = handler
+  # Assigned rather than removed one by one, which would take the logging
+  # module's lock.
+  bot.handlers = []
+  root.handlers = list(handlers.values())
+
+def _serve(makeWrapped, conn):
+  """Runs in a ProcessFacade worker process, answering the calls sent down
+  conn until it is told to stop."""
+  # Interrupting the bot interrupts its whole process group; the bot stops
+  # its workers itself.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  _closeInheritedSockets([0, 1, 2, conn.fileno()])
+  _reopenLogs()
+  wrapped = None
+  error = None
+  try:
+    wrapped = makeWrapped()
+  except Exception as e:
+    logging.exception("Could not create wrapped object")
+    error = e
+  while True:
+    try:
+      job = conn.recv()
+    except (EOFError, IOError, OSError):
+      return
+    if job is None:
+      return
+    (id, key, args, kwargs, queued) = job
+    start = time.time()
+    try:
+      if error is not None:
+        raise error
+      val = getattr(wrapped, key)(*args, **kwargs)
+      failure = None
+    except Exception as e:
+      val = None
+      failure = e
+    ran = time.time() - start
+    try:
+      conn.send((id, key, val, failure, start - queued, ran))
+    except Exception as e:
+      conn.send((id, key, None, RuntimeError("Could not return the result "
+                 "of %s: %s" % (key, e)), start - queued, ran))
+
+class _ProcessShard(object):
+  """A worker process, and the threads which send it calls and collect
+  their results.  Only the sender thread ever waits on the pipe to the
+  process, so Promise callbacks, which run on the collector thread, may
+  schedule more calls."""
+  def __init__(self, makeWrapped, name):
+    self.name = name
+    self.calls = {}
+    self.nextId = 0
+    self.lock = threading.Lock()
+    self.jobs = Queue.Queue()
+    self.processed = 0
+    self.waited = 0.0
+    self.maxWait = 0.0
+    self.timings = {}
+    (self.conn, child) = forking.Pipe()
+    self.process = forking.Process(target=_serve, args=(makeWrapped, child),
+                                   name=name)
+    self.process.daemon = True
+    self.process.start()
+    child.close()
+    self.sender = threading.Thread(target=self.send, name=name + '-send')
+    self.sender.daemon = True
+    self.sender.start()
+    self.collector = threading.Thread(target=self.collect,
+                                      name=name + '-collect')
+    self.collector.daemon = True
+    self.collector.start()
+
+  def send(self):
+    while True:
+      job = self.jobs.get()
+      try:
+        self.conn.send(job)
+      except Exception as e:
+        if job is not None:
+          with self.lock:
+            promise = self.calls.pop(job[0], None)
+          if promise is not None:
+            promise.errored(e)
+      if job is None:
+        return
+
+  def collect(self):
+    while True:
+      try:
+        (id, key, val, failure, waited, ran) = self.conn.recv()
+      except (EOFError, IOError, OSError):
+        break
+      self.processed += 1
+      self.waited += waited
+      self.maxWait = max(self.maxWait, waited)
+      if key not in self.timings:
+        self.timings[key] = (timing.Histogram(), timing.Histogram())
+      (waits, runs) = self.timings[key]
+      waits.add(waited)
+      runs.add(ran)
+      with self.lock:
+        promise = self.calls.pop(id)
+      if failure is not None:
+        promise.errored(failure)
+      else:
+        promise.finish(val)
+    with self.lock:
+      calls, self.calls = self.calls, {}
+    for promise in calls.values():
+      promise.errored(RuntimeError("%s exited" % self.name))
+
+  def schedule(self, key, args, kwargs):
+    p = Promise()
+    logging.debug("Scheduling %r", key)
+    with self.lock:
+      id = self.nextId
+      self.nextId += 1
+      self.calls[id] = p
+    self.jobs.put((id, key, args, kwargs, time.time()))
+    return p
+
+  def stop(self):
+    self.jobs.put(None)
+
+  def stats(self):
+    return {
+      'queued': len(self.calls),
+      'processed': self.processed,
+      'averageWait': self.waited / max(self.processed, 1),
+      'maxWait': self.maxWait
+    }
+
+class ProcessFacade(object):
+  """Like ThreadProtectionFacade, but runs the wrapped objects in worker
+  processes, so that matching in different channels can use more than one
+  core.
+
+  Each process creates its own instance of the wrapped class, and calls
+  are sharded on their channel just the same, so a process owns the
+  database files and matchers of its channels.  Arguments and results are
+  pickled across, and only methods of the wrapped objects can be used.
+  The processes are forked, so this needs a platform which can fork.  A
+  worker closes the sockets it inherited and logs through handlers of its
+  own, but anything else the bot's other threads were doing at the time,
+  such as holding a lock, is copied into it as it was.
+  """
+  def __init__(self, wrappedClass, *args, **kwargs):
+    self.__shards = []
+    if forking is None:
+      raise RuntimeError('ProcessFacade needs a platform which can fork.')
+    processes = kwargs.pop('processes', 1)
+
+    def f():
+      return wrappedClass(*args, **kwargs)
+
+    for i in range(max(processes, 1)):
+      self.__shards.append(_ProcessShard(f, 'ProcessFacade-%i' % i))
+
+  def __del__(self):
+    self._dispose()
+
+  def _dispose(self):
+    """Stops the processes once the calls already queued are done."""
+    for shard in self.__shards:
+      shard.stop()
+    for shard in self.__shards:
+      shard.process.join(5)
+    self.__shards = []
+
+  def _shardFor(self, channel):
+    return self.__shards[hash(ircutils.toLower(channel)) % len(self.__shards)]
+
+  def _queueDepth(self, channel):
+    """Returns the number of calls waiting ahead of a call for channel."""
+    return len(self._shardFor(channel).calls)
+
+  def _stats(self):
+    """Returns the queue depth and wait times of every process."""
+    return [shard.stats() for shard in self.__shards]
+
+  def _methodStats(self):
+    """Returns the queue wait and run time Histograms of every method, summed
+    over all processes."""
+    methods = {}
+    for shard in self.__shards:
+      for (key, (waits, runs)) in list(shard.timings.items()):
+        if key not in methods:
+          methods[key] = (timing.Histogram(), timing.Histogram())
+        methods[key][0].merge(waits)
+        methods[key][1].merge(runs)
+    return methods
+
+  def __schedule(self, key, args, kwargs):
+    if args and isinstance(args[0], basestring):
+      return self._shardFor(args[0]).schedule(key, args, kwargs)
+    return _GatheredPromise([shard.schedule(key, args, kwargs)
+                             for shard in self.__shards])
+
+  def __getattr__(self, key):
+    # The wrapped objects only exist in the processes, so any public name
+    # is taken to be one of their methods.
+    if key.startswith('_'):
+      raise AttributeError(key)
+    def schedule(*args, **kwargs):
+      return self.__schedule(key, args, kwargs)
+    return schedule
+
+class PromiseAdapter(object):
+  """Gives an aio.AsyncioFacade the interface of ThreadProtectionFacade,
+  returning Promises instead of futures, so the plugin can run on either."""
+  def __init__(self, facade):
+    self.__facade = facade
+
+  def _dispose(self):
+    self.__facade.dispose()
+
+  def _queueDepth(self, channel):
+    return self.__facade.queueDepth(channel)
+
+  def _stats(self):
+    return self.__facade.stats()
+
+  def _methodStats(self):
+    return self.__facade.methodStats()
+
+  def __getattr__(self, key):
+    if key.startswith('_PromiseAdapter__'):
+      raise AttributeError(key)
+    facade = self.__facade
+    def schedule(*args, **kwargs):
+      promises = [Promise.fromFuture(future)
+                  for future in facade.submit(key, *args, **kwargs)]
+      if args and isinstance(args[0], basestring):
+        return promises[0]
+      return _GatheredPromise(promises)
+    return schedule
 
 class SQLiteWhatisDB(object):
-    def __init__(self, filename):
-        self.dbs = ircutils.IrcDict()
+    """Writes are batched: they are committed once batchSize of them are
+    pending for a database file, or at most batchInterval seconds after
+    the first of them, as long as flush() is called every half
+    batchInterval.
+
+    Each channel has its own database file, unless singleFile is set, in
+    which case every channel's reactions are kept in filename with a channel
+    column.  At most maxOpen files are kept open; opening another closes
+    the least recently used one, and flush() also closes files unused for
+    idleTimeout seconds.  Matchers are kept when their file is closed."""
+    def __init__(self, filename, batchSize=1, batchInterval=0, cacheSize=256,
+                 cacheTtl=300, matchBudget=0, maxOpen=32, idleTimeout=0,
+                 singleFile=False):
+        self.dbs = OrderedDict()
+        self.used = {}
+        self.matchers = ircutils.IrcDict()
+        self.pending = {}
         self.filename = filename
+        self.batchSize = max(batchSize, 1)
+        self.batchInterval = batchInterval
+        self.journalMode = 'wal'
+        self.cacheSize = cacheSize
+        self.cacheTtl = cacheTtl
+        self.matchBudget = matchBudget
+        self.maxOpen = max(maxOpen, 1)
+        self.idleTimeout = idleTimeout
+        self.singleFile = singleFile
+        # The statements only differ between the two layouts, so each is
+        # built once here and sqlite3 reuses its prepared form afterwards.
+        columns = bulk.COLUMNS + matcher.DERIVED
+        if singleFile:
+            scope = "channel = ?"
+            columns = ('channel',) + columns
+        else:
+            scope = "1"
+        self.sql = {
+            'load': "SELECT pattern, reaction, person, frequency, %s FROM Reactions WHERE %s AND valid = 1" % (', '.join(matcher.DERIVED), scope),
+            'get': "SELECT reaction, pattern, person, frequency FROM Reactions WHERE %s AND patternHash = ? AND pattern = ? ORDER BY reaction" % scope,
+            'add': "INSERT OR ABORT INTO Reactions (%s) VALUES (%s)" % (', '.join(columns), ', '.join('?' * len(columns))),
+            'forget': "DELETE FROM Reactions WHERE %s AND pattern = ? AND reaction = ?" % scope
+        }
 
     def close(self):
-        for db in self.dbs.itervalues():
-            db.commit()
-            db.close()
+        for filename in list(self.dbs):
+            self._closeDb(filename)
+
+    def _filename(self, channel):
+        if self.singleFile:
+            return self.filename
+        return plugins.makeChannelFilename(self.filename, channel)
+
+    def _scope(self, channel):
+        """Returns the parameters selecting channel's rows in the statements
+        of self.sql."""
+        if self.singleFile:
+            return (ircutils.toLower(channel),)
+        return ()
+
+    def _closeDb(self, filename):
+        db = self.dbs.pop(filename)
+        db.commit()
+        db.close()
+        self.pending.pop(filename, None)
+        self.used.pop(filename, None)
+
+    def _commit(self, filename):
+        self.dbs[filename].commit()
+        self.pending.pop(filename, None)
+
+    def _unchanged(self, channel):
+        """Ends the transaction a statement which changed nothing may have
+        begun, unless it also holds pending writes, so the file isn't kept
+        locked by a transaction flush() doesn't know of."""
+        filename = self._filename(channel)
+        if filename not in self.pending:
+            self.dbs[filename].commit()
+
+    def _wrote(self, channel):
+        filename = self._filename(channel)
+        (count, since) = self.pending.get(filename, (0, time.time()))
+        self.pending[filename] = (count + 1, since)
+        if count + 1 >= self.batchSize or \
+                time.time() - since >= self.batchInterval:
+            self._commit(filename)
+
+    def flush(self, force=False):
+        """Commits the pending writes of every file whose oldest pending
+        write is at least half of batchInterval old, or of all files if
+        force is set, then closes the files which have been idle for too
+        long.  Returns the number of files committed."""
+        now = time.time()
+        due = [filename for (filename, (count, since)) in self.pending.items()
+               if force or now - since >= self.batchInterval / 2.0]
+        for filename in due:
+            self._commit(filename)
+        if self.idleTimeout > 0:
+            for (filename, used) in list(self.used.items()):
+                if now - used >= self.idleTimeout:
+                    self._closeDb(filename)
+        return len(due)
+
+    def durability(self):
+        """Returns how much may be lost if the bot crashes."""
+        return {
+            'journal': self.journalMode,
+            'synchronous': 'normal',
+            'writes': self.batchSize - 1,
+            'seconds': self.batchInterval
+        }
 
     def _getDb(self, channel):
-        if channel not in self.dbs:
-            filename = plugins.makeChannelFilename(self.filename, channel)
-            self.dbs[channel] = sqlite3.connect(filename)
-            self.dbs[channel].text_factory = str
-            c = self.dbs[channel].execute("PRAGMA user_version");
-            version = c.fetchone()[0]
-            self._upgradeDb(self.dbs[channel], version)
-            self.dbs[channel].create_function("REGEXP", 2, regexp)
-        return self.dbs[channel]
-
-    def _upgradeDb(self, db, current):
+        filename = self._filename(channel)
+        db = self.dbs.pop(filename, None)
+        if db is None:
+            db = self._openDb(filename)
+        # Most recently used last.
+        self.dbs[filename] = db
+        self.used[filename] = time.time()
+        while len(self.dbs) > self.maxOpen:
+            self._closeDb(next(iter(self.dbs)))
+        return db
+
+    def _openDb(self, filename):
+        # Another database thread sharing the file may hold the write lock
+        # until its batch is flushed, which can take up to an interval.
+        db = sqlite3.connect(filename, timeout=max(5, self.batchInterval + 1))
+        db.text_factory = str
+        # In WAL mode NORMAL only syncs at checkpoints: committed
+        # transactions survive the bot crashing, though the most recent
+        # ones may not survive the machine losing power.
+        c = db.execute("PRAGMA journal_mode=WAL")
+        self.journalMode = c.fetchone()[0]
+        db.execute("PRAGMA synchronous=NORMAL")
+        c = db.execute("PRAGMA user_version");
+        if c.fetchone()[0] < bulk.SCHEMA or \
+                bulk.derivedBy(db) != matcher.DERIVED_BY:
+            self._upgradeDb(db)
+        return db
+
+    def _getMatcher(self, channel):
+        if channel not in self.matchers:
+            c = self._getDb(channel).cursor()
+            c.execute(self.sql['load'], self._scope(channel))
+            # The derived columns spare parsing every pattern again.
+            rows = (row[:4] + (row[4:],) for row in c)
+            self.matchers[channel] = matcher.ChannelMatcher(rows,
+                    self.cacheSize, self.cacheTtl, self.matchBudget)
+        return self.matchers[channel]
+
+    def _upgradeDb(self, db):
+        # Something else may be opening the same file at the same time, such
+        # as the bot's other database threads in singleFile mode, so the
+        # version is read again once the write lock is held and only the
+        # first to get it upgrades the file.  The sqlite3 module would
+        # commit before each CREATE and ALTER, so the transaction is
+        # managed here instead.
+        db.isolation_level = None
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            c = db.execute("PRAGMA user_version")
+            self._upgradeSchema(db, c.fetchone()[0])
+            # What analyze() makes of a pattern depends on the version of
+            # Python, so the derived columns are worked out again when the
+            # file was last analyzed by another one.
+            if bulk.derivedBy(db) != matcher.DERIVED_BY:
+                c = db.execute("SELECT DISTINCT pattern FROM Reactions")
+                db.executemany("UPDATE Reactions SET literal = ?, keywords = ?, valid = ?, risk = ?, patternHash = ? WHERE pattern = ?",
+                               [matcher.analyze(pattern) + (pattern,)
+                                for (pattern,) in c.fetchall()])
+                db.execute("INSERT OR REPLACE INTO Meta (name, value) VALUES ('derivedBy', ?)",
+                           (matcher.DERIVED_BY,))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.isolation_level = ''
+
+    def _upgradeSchema(self, db, current):
+        if current >= bulk.SCHEMA:
+            return
         if (current == 0):
             current=1
-            db.execute("CREATE TABLE Reactions (pattern TEXT KEY, reaction TEXT KEY, person TEXT, frequency REAL)")
-            db.execute("CREATE UNIQUE INDEX reactionPair ON Reactions (pattern, reaction)")
+            if self.singleFile:
+                db.execute("CREATE TABLE IF NOT EXISTS Reactions (channel TEXT, pattern TEXT KEY, reaction TEXT KEY, person TEXT, frequency REAL)")
+                db.execute("CREATE UNIQUE INDEX IF NOT EXISTS reactionPair ON Reactions (channel, pattern, reaction)")
+            else:
+                db.execute("CREATE TABLE IF NOT EXISTS Reactions (pattern TEXT KEY, reaction TEXT KEY, person TEXT, frequency REAL)")
+                db.execute("CREATE UNIQUE INDEX IF NOT EXISTS reactionPair ON Reactions (pattern, reaction)")
+        if (current == 1):
+            current=2
+            # What matching needs to know about each pattern, worked out
+            # once when it is stored rather than every time it is loaded.
+            # They are filled in by _upgradeDb(), as Meta says they haven't
+            # been yet.
+            for column in ("literal INTEGER", "keywords TEXT",
+                           "valid INTEGER", "risk TEXT",
+                           "patternHash INTEGER"):
+                db.execute("ALTER TABLE Reactions ADD COLUMN %s" % column)
+            if self.singleFile:
+                db.execute("CREATE INDEX IF NOT EXISTS patternHashes ON Reactions (channel, patternHash)")
+            else:
+                db.execute("CREATE INDEX IF NOT EXISTS patternHashes ON Reactions (patternHash)")
+        if (current == 2):
+            current=3
+            # Which Python worked out the derived columns, as derivedBy.
+            db.execute("CREATE TABLE IF NOT EXISTS Meta (name TEXT PRIMARY KEY, value TEXT)")
         db.execute("PRAGMA user_version=%i"%current)
-        db.commit()
 
     def getReactions(self, channel, pattern):
         c = self._getDb(channel).cursor()
-        c.execute("SELECT reaction, pattern, person, frequency FROM Reactions WHERE pattern = ? ORDER BY reaction", (pattern,))
+        c.execute(self.sql['get'], self._scope(channel) +
+                  (matcher.patternHash(pattern), pattern))
+
+        return [matcher.Reaction(r[1], r[0], r[2], r[3]) for r in c]
 
-        ret = []
+    def cacheStats(self, channel):
+        return self._getMatcher(channel).cache.stats()
 
-        for reaction in c:
-            ret.append({
-                'reaction': reaction[0],
-                'pattern': reaction[1],
-                'person': reaction[2],
-                'frequency': reaction[3]
-            })
-        return ret
+    def matchStats(self, channel):
+        return self._getMatcher(channel).stats()
+
+    def quarantined(self, channel):
+        """Returns the quarantined patterns of channel and the reasons
+        they were quarantined, sorted by pattern."""
+        return sorted(self._getMatcher(channel).quarantined.items())
+
+    def suggestPatterns(self, channel, text, distance, limit=3):
+        """Returns the patterns of channel nearest to text, if they are
+        within distance edits of it, and at most limit of them."""
+        return self._getMatcher(channel).suggest(text, distance, limit)
 
     def produceReaction(self, channel, text):
-        c = self._getDb(channel).cursor()
-        c.execute("SELECT reaction, pattern, person, frequency FROM Reactions WHERE REGEXP(pattern, ?) ORDER BY RANDOM() * frequency LIMIT 1", (text,))
-        res = c.fetchone()
-        if res:
-            return {
-                'reaction': res[0],
-                'pattern': res[1],
-                'person': res[2],
-                'frequency': res[3]
-            }
-        return None
+        m = self._getMatcher(channel)
+        return m.choose(m.match(text))
 
     def addReaction(self, channel, pattern, reaction, person=None, frequency=1):
         if person is None:
             person = "instinct"
+        derived = matcher.analyze(pattern)
         c = self._getDb(channel).cursor()
         try:
-            c.execute("INSERT OR ABORT INTO Reactions (pattern, reaction, person, frequency) VALUES (?, ?, ?, ?)", (pattern, reaction, person, frequency))
-            return True
-        except:
+            c.execute(self.sql['add'], self._scope(channel) +
+                      (pattern, reaction, person, frequency) + derived)
+        except sqlite3.IntegrityError:
+            self._unchanged(channel)
             return False
+        except Exception:
+            self._unchanged(channel)
+            raise
+        self._wrote(channel)
+        self._getMatcher(channel).add(pattern, reaction, person, frequency,
+                                      derived)
+        return True
 
 
     def forgetReaction(self, channel, pattern, reaction):
         c = self._getDb(channel).cursor()
-        res = c.execute("DELETE FROM Reactions WHERE pattern = ? AND reaction = ?",
-                (pattern,reaction))
-        self._getDb(channel).commit()
-        return bool(res.rowcount > 0)
+        res = c.execute(self.sql['forget'],
+                self._scope(channel) + (pattern, reaction))
+        if res.rowcount > 0:
+            self._wrote(channel)
+            self._getMatcher(channel).remove(pattern, reaction)
+            return True
+        self._unchanged(channel)
+        return False
+
+    def exportReactions(self, channel, filename):
+        """Writes channel's reactions to filename.  Returns the number of
+        reactions written and the time it took."""
+        db = self._getDb(channel)
+        if self._filename(channel) in self.pending:
+            self._commit(self._filename(channel))
+        start = time.time()
+        f = bulk.openFile(filename, 'w')
+        try:
+            count = bulk.exportReactions(db, f, bulk.formatFor(filename),
+                                         *self._scope(channel))
+        finally:
+            f.close()
+        return (count, time.time() - start)
+
+    def importReactions(self, channel, filename):
+        """Adds the reactions in filename to channel, skipping ones it already
+        has.  Returns the number of reactions read, the number added and the
+        time it took."""
+        db = self._getDb(channel)
+        if self._filename(channel) in self.pending:
+            self._commit(self._filename(channel))
+        start = time.time()
+        f = bulk.openFile(filename, 'r')
+        try:
+            (read, inserted) = bulk.importReactions(db,
+                    bulk.readReactions(f, bulk.formatFor(filename)),
+                    *self._scope(channel))
+        finally:
+            f.close()
+        # Reloaded from the table the next time the channel is matched.
+        self.matchers.pop(channel, None)
+        return (read, inserted, time.time() - start)
 
 WhatisDB = plugins.DB('Whatis', {'sqlite': SQLiteWhatisDB})
 
+class TokenBucket(object):
+    """Allows an action every interval seconds on average, and up to
+    capacity of them in a burst."""
+    def __init__(self, interval, capacity=1):
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        if self.interval <= 0:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity,
+                    self.tokens + (now - self.last) / float(self.interval))
+        self.last = now
+
+    def ready(self):
+        """Returns whether take() would currently succeed."""
+        with self.lock:
+            self._refill()
+            return self.tokens >= 1
+
+    def take(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
 class Whatis(callbacks.PluginRegexp):
     """Add the help for "@plugin help Whatis" here
     This should describe *how* to use this plugin."""
@@ -245,14 +985,76 @@ class Whatis(callbacks.PluginRegexp):
         self.__jobs = Queue.Queue()
         self.__parent = super(Whatis, self)
         self.__parent.__init__(irc)
-        self.db = ThreadProtectionFacade(WhatisDB)
+        # Every channel shares one file in singleFile mode, and a batch of
+        # writes holds its lock until it is committed, so a single database
+        # thread or process handles them all rather than several waiting
+        # on each other.
+        if self.registryValue('databases.singleFile'):
+            shards = 1
+        else:
+            shards = None
+        if self.registryValue('processes'):
+            facade = functools.partial(ProcessFacade,
+                    processes=shards or self.registryValue('processes'))
+        else:
+            facade = functools.partial(ThreadProtectionFacade,
+                    workers=shards or self.registryValue('workers'))
+        self.db = facade(WhatisDB,
+                batchSize=self.registryValue('writes.batchSize'),
+                batchInterval=self.registryValue('writes.batchInterval'),
+                cacheSize=self.registryValue('cache.size'),
+                cacheTtl=self.registryValue('cache.ttl'),
+                matchBudget=self.registryValue('matchBudget'),
+                maxOpen=self.registryValue('databases.maxOpen'),
+                idleTimeout=self.registryValue('databases.idleTimeout'),
+                singleFile=self.registryValue('databases.singleFile'))
         self.explanations = ircutils.IrcDict()
+        self.buckets = ircutils.IrcDict()
+        self.shed = 0
+        self.commands = {}
+        self.capabilities = matcher.ResultCache(256, 60)
+        self.commandLock = threading.Lock()
+        # Flushing every half interval commits every write within an
+        # interval of it.
+        schedule.addPeriodicEvent(self.db.flush,
+                max(self.registryValue('writes.batchInterval') / 2.0, 0.5),
+                name='WhatisFlush', now=False)
+        def durable(bounds):
+            self.log.info('Whatis: using %s journaling with synchronous=%s. '
+                    'A crash loses at most the last %i writes or %.1f '
+                    'seconds of writes of each database file.',
+                    bounds['journal'], bounds['synchronous'],
+                    bounds['writes'], bounds['seconds'])
+        self._later(self.db.durability(), lambda bounds: durable(bounds[0]))
+        if self.registryValue('statsInterval'):
+            schedule.addPeriodicEvent(self._logStats,
+                    self.registryValue('statsInterval'), name='WhatisStats',
+                    now=False)
 
     def die(self):
         self.__parent.die()
-        self.db.close()
+        schedule.removePeriodicEvent('WhatisFlush')
+        if self.registryValue('statsInterval'):
+            schedule.removePeriodicEvent('WhatisStats')
+        # Wait for the files to be closed, so nothing touches them once the
+        # plugin is gone.
+        self.db.close().result()
         self.db._dispose()
 
+    def _later(self, promise, callback, irc=None):
+        """Calls callback with the result of promise once the database
+        thread has resolved it, instead of blocking this thread on it.  If
+        anything goes wrong and irc is given, an error is replied."""
+        def done(promise):
+            try:
+                callback(promise.result())
+            except Exception:
+                self.log.exception('Error handling a database result:')
+                if irc is not None:
+                    irc.replyError()
+        promise.addDoneCallback(done)
+        return promise
+
     def explain(self, irc, msg, args, channel, text):
         """[<channel>] [<text>]
 
@@ -261,24 +1063,158 @@ class Whatis(callbacks.PluginRegexp):
         """
         if (not text):
             if (channel in self.explanations.keys()):
-                explanation = self.explanations[channel]
-                reaction = explanation[0]
-                pattern = explanation[1]
-                nick = explanation[2]
-                freq = explanation[3]
-                irc.reply("%(person)s taught me that '%(pattern)s' was '%(reaction)s' %(frequency)f% of the time" % reaction)
+                reaction = self.explanations[channel]
+                irc.reply("%(person)s taught me that '%(pattern)s' was '%(reaction)s' %(frequency)f%% of the time" % reaction)
             else:
                 irc.reply("I haven't said anything yet.")
         else:
-            reactions = self.db.getReactions(channel, text).result()
-            if len(reactions) == 0:
-                irc.reply("I have no idea what you are talking about.")
-            else:
-                reactions = map(lambda r: "%(person)s: P('%(reaction)s')=%(frequency).1f"%r, reactions)
-                irc.reply(("'%s' is "%(text))+', '.join(reactions))
+            def explained(reactions):
+                if len(reactions) == 0:
+                    self._suggest(irc, channel, text,
+                            "I have no idea what you are talking about.")
+                else:
+                    reactions = map(lambda r: "%(person)s: P('%(reaction)s')=%(frequency).1f"%r, reactions)
+                    irc.reply(("'%s' is "%(text))+', '.join(reactions))
+            self._later(self.db.getReactions(channel, text), explained, irc)
 
     explain = wrap(explain, ['channeldb', optional('text')])
 
+    def _suggest(self, irc, channel, pattern, notFound):
+        """Replies notFound, followed by the known patterns of channel
+        closest to pattern, if there are any."""
+        distance = self.registryValue('suggestionDistance', channel)
+        if not distance:
+            irc.reply(notFound)
+            return
+        def suggested(patterns):
+            if patterns:
+                irc.reply("%s Did you mean %s?" % (notFound,
+                          ' or '.join(["'%s'" % p for p in patterns])))
+            else:
+                irc.reply(notFound)
+        self._later(self.db.suggestPatterns(channel, pattern, distance),
+                    suggested, irc)
+
+    def cachestats(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Returns how many recently seen lines of <channel> I remember the
+        matching patterns for, and how often that saved looking them up.
+        """
+        def reply(stats):
+            lookups = stats['hits'] + stats['misses']
+            irc.reply("%i lines cached, %.1f%% hit ratio (%i hits, %i misses)."
+                      % (stats['size'], 100.0 * stats['hits'] / max(lookups, 1),
+                         stats['hits'], stats['misses']))
+        self._later(self.db.cacheStats(channel), reply, irc)
+
+    cachestats = wrap(cachestats, ['channeldb'])
+
+    def _describeStats(self):
+        stats = []
+        for (key, (waits, runs)) in sorted(self.db._methodStats().items()):
+            waits = waits.summary()
+            stats.append("%s: %i calls, queued %s, ran %s" % (key,
+                waits['count'], timing.describe(waits),
+                timing.describe(runs.summary())))
+        waits = Promise.waits.summary()
+        stats.append("blocked on %i promises, %s" % (waits['count'],
+            timing.describe(waits)))
+        return stats
+
+    def _logStats(self):
+        for line in self._describeStats():
+            self.log.info('Whatis stats: %s', line)
+
+    def stats(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Returns how long database calls have waited in their queues and taken
+        to run, and how long anything blocked waiting for their results. With
+        <channel>, returns how many lines were matched in <channel>, how many
+        patterns that took trying and how long it took.
+        """
+        if channel is None:
+            irc.reply('; '.join(self._describeStats()))
+            return
+        def reply(stats):
+            irc.reply("%s: %i patterns (%i indexed, %i literal, %i "
+                      "quarantined), %i lookups (%i cached), %i patterns "
+                      "tried, %i matched, matching took %s" %
+                      (channel, stats['patterns'], stats['indexed'],
+                       stats['literal'], stats['quarantined'],
+                       stats['lookups'], stats['cached'], stats['scanned'],
+                       stats['matched'], timing.describe(stats['timing'])))
+        self._later(self.db.matchStats(channel), reply, irc)
+
+    stats = wrap(stats, [additional('validChannel')])
+
+    def quarantined(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Returns the patterns of <channel> I no longer try to match, because
+        they could take forever to match or once took too long to.
+        Forgetting them removes them for good.
+        """
+        def reply(quarantined):
+            if not quarantined:
+                irc.reply("No patterns are quarantined in %s." % channel)
+            else:
+                irc.reply(', '.join(["'%s' (%s)" % (pattern, reason)
+                                     for (pattern, reason) in quarantined]))
+        self._later(self.db.quarantined(channel), reply, irc)
+
+    quarantined = wrap(quarantined, ['channeldb'])
+
+    def exportfile(self, irc, msg, args, channel, filename):
+        """[<channel>] <filename>
+
+        Writes everything I know for <channel> to <filename>, as CSV if its
+        name ends in .csv and as JSON Lines otherwise. Relative filenames are
+        in the bot's data directory.
+        """
+        filename = conf.supybot.directories.data.dirize(filename)
+        def exported(result):
+            (count, elapsed) = result
+            irc.reply("Exported %i reactions to %s in %.2fs (%.0f rows/s)." %
+                      (count, filename, elapsed, count / max(elapsed, 1e-6)))
+        self._later(self.db.exportReactions(channel, filename), exported, irc)
+
+    exportfile = wrap(exportfile, ['owner', 'channeldb', 'something'])
+
+    def importfile(self, irc, msg, args, channel, filename):
+        """[<channel>] <filename>
+
+        Learns every reaction in <filename>, which is read as CSV if its name
+        ends in .csv and as JSON Lines otherwise, skipping the ones I already
+        know. Relative filenames are in the bot's data directory.
+        """
+        filename = conf.supybot.directories.data.dirize(filename)
+        def imported(result):
+            (read, inserted, elapsed) = result
+            irc.reply("Imported %i of %i reactions in %.2fs (%.0f rows/s)." %
+                      (inserted, read, elapsed, read / max(elapsed, 1e-6)))
+        self._later(self.db.importReactions(channel, filename), imported, irc)
+
+    importfile = wrap(importfile, ['owner', 'channeldb', 'something'])
+
+    def queues(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the number of queued jobs and the average and longest time
+        jobs have waited in the queue for each database thread.
+        """
+        shards = []
+        for (i, stats) in enumerate(self.db._stats()):
+            shards.append("#%i: %i queued, %i done, waited %.1fms on "
+                          "average and %.1fms at most" % (i, stats['queued'],
+                          stats['processed'], stats['averageWait'] * 1000,
+                          stats['maxWait'] * 1000))
+        shards.append("%i lookups shed" % self.shed)
+        irc.reply('; '.join(shards))
+
+    queues = wrap(queues)
+
     def forget(self, irc, msg, args, channel, text):
         """[<channel>] [that] <text> OR [that] <pattern> is <text>
 
@@ -289,25 +1225,49 @@ class Whatis(callbacks.PluginRegexp):
 
         text = re.match("(?:that )?(.+)", text).groups()[0]
         definitionSplit = re.match("(.+)\s+is\s+(.+)", text)
-        if definitionSplit:
-            pattern, reaction = definitionSplit.groups()
-            if self.db.forgetReaction(channel, pattern, reaction).result():
+
+        def forgotten(success):
+            if success:
                 irc.replySuccess()
-                return
-        if channel in self.explanations and self.explanations[channel]['pattern'] == text:
-            if self.db.forgetReaction(channel, text, self.explanations[channel]['reaction']):
+            else:
+                irc.reply("I don't remember anything about that.")
+
+        def byReactions(reactions):
+            if len(reactions) == 1:
+                self._later(self.db.forgetReaction(channel, text,
+                    reactions[0]['reaction']), forgotten, irc)
+            elif len(reactions) == 0:
+                if definitionSplit:
+                    pattern = definitionSplit.group(1)
+                else:
+                    pattern = text
+                self._suggest(irc, channel, pattern,
+                              "I don't remember anything about that.")
+            else:
+                irc.reply("You'll have to be more specific about what I'm forgetting.")
+
+        def byLookup(success=False):
+            if success:
                 irc.replySuccess()
                 return
+            self._later(self.db.getReactions(channel, text), byReactions, irc)
 
-        reactions = self.db.getReactions(channel, text).result()
-
-        if len(reactions) == 1:
-            if self.db.forgetReaction(channel, text, reactions[0]['reaction']):
+        def byExplanation(success=False):
+            if success:
                 irc.replySuccess()
-        elif len(reactions) == 1:
-            irc.reply("I don't remember anything about that.")
+                return
+            if channel in self.explanations and self.explanations[channel]['pattern'] == text:
+                self._later(self.db.forgetReaction(channel, text,
+                    self.explanations[channel]['reaction']), byLookup, irc)
+            else:
+                byLookup()
+
+        if definitionSplit:
+            pattern, reaction = definitionSplit.groups()
+            self._later(self.db.forgetReaction(channel, pattern, reaction),
+                    byExplanation, irc)
         else:
-            irc.reply("You'll have to be more specific about what I'm forgetting.")
+            byExplanation()
 
     forget = wrap(forget, ['channeldb', 'text'])
 
@@ -320,15 +1280,32 @@ class Whatis(callbacks.PluginRegexp):
         self.log.info("Learning that '%s' means '%s'!", pattern, reaction)
         channel = plugins.getChannel(msg.args[0])
         msg.tag("repliedTo")
+        # The reply comes later from a database thread, so claim the message
+        # now; otherwise the remaining invalidCommand handlers (such as Misc's
+        # "not a valid command") run too.
+        irc.noReply()
+
+        risk = matcher.backtrackingRisk(pattern)
+        if risk:
+            irc.reply("I won't learn that, '%s' could take forever to match "
+                      "(%s)." % (pattern, risk))
+            return
 
-        if self.db.addReaction(channel, pattern, reaction).result():
-            existing = self.db.getReactions(channel, pattern).result()
+        def counted(existing):
             if len(existing) > 1:
                 irc.reply("I now have %d meanings for %s."%(len(existing), pattern))
             else:
                 irc.replySuccess()
-        else:
-            irc.reply("I already knew that.")
+
+        def learned(added):
+            if added:
+                self._later(self.db.getReactions(channel, pattern), counted,
+                        irc)
+            else:
+                irc.reply("I already knew that.")
+
+        self._later(self.db.addReaction(channel, pattern, reaction), learned,
+                irc)
 
     def doPrivmsg(self, irc, msg):
         if (irc.isChannel(msg.args[0])):
@@ -336,38 +1313,138 @@ class Whatis(callbacks.PluginRegexp):
             channel = plugins.getChannel(msg.args[0])
 
             if (not msg.tagged("repliedTo")):
+                if self._autolearn(channel, irc, msg):
+                    return
+                if not self.registryValue('automaticReplies', channel):
+                    return
+                # Matching is skipped altogether when the reply would be
+                # throttled, or when the channel's database thread is
+                # already too far behind to answer in time.
+                if not self._getBucket(channel).ready():
+                    return
+                maxQueue = self.registryValue('maxQueue')
+                if maxQueue and self.db._queueDepth(channel) >= maxQueue:
+                    self.shed += 1
+                    self.log.debug('Shedding lookup in %s, %i jobs queued.',
+                            channel, self.db._queueDepth(channel))
+                    return
                 self._reply(channel, irc, msg, False)
 
-    @staticmethod
-    def extractTag(text):
-        matches = re.match("(<.+>)?(.+)", text)
-        if matches:
-            tag, text = matches.groups()
-            return (tag[1:-1], text)
-        return (None, text)
+    def _getBucket(self, channel):
+        interval = self.registryValue('rate', channel)
+        capacity = self.registryValue('burst', channel)
+        bucket = self.buckets.get(channel)
+        if bucket is None:
+            bucket = self.buckets[channel] = TokenBucket(interval, capacity)
+        bucket.interval = interval
+        bucket.capacity = capacity
+        return bucket
+
+    def _autolearn(self, channel, irc, msg):
+        if not self.registryValue('autolearn', channel) or \
+                callbacks.addressed(irc.nick, msg):
+            return False
+        match = re.match(self.doRemember.__doc__, msg.args[1])
+        if match is None:
+            return False
+        (pattern, reaction) = match.groups()
+        if matcher.backtrackingRisk(pattern):
+            self.log.info("Not learning '%s', it could take forever to "
+                    "match.", pattern)
+            return True
+        self.log.info("Overheard that '%s' means '%s'.", pattern, reaction)
+        self._later(self.db.addReaction(channel, pattern, reaction, msg.nick),
+                lambda added: None)
+        return True
+
+    def _findCommand(self, irc, command):
+        """Returns the callback providing command, looking it up only when
+        it wasn't found before or its plugin has been unloaded since."""
+        cb = self.commands.get(command)
+        if cb is None or cb not in irc.callbacks:
+            cb = None
+            for candidate in irc.callbacks:
+                if hasattr(candidate, 'getCommand') and \
+                        candidate.getCommand([command]) == [command]:
+                    cb = candidate
+                    break
+            self.commands[command] = cb
+        return cb
+
+    def _mayCall(self, msg, cb, command):
+        """Returns whether msg's sender may call command, remembering the
+        answer for a minute."""
+        key = (msg.prefix, msg.args[0], cb.name(), command)
+        with self.commandLock:
+            allowed = self.capabilities.get(key)
+        if allowed is None:
+            name = cb.name().lower()
+            allowed = not (callbacks.checkCommandCapability(msg, cb, command)
+                    or callbacks.checkCommandCapability(msg, cb, [name])
+                    or callbacks.checkCommandCapability(msg, cb,
+                                                        [name, command]))
+            with self.commandLock:
+                self.capabilities.put(key, allowed)
+        return allowed
+
+    def _callDirectly(self, irc, msg, command, text, deliver):
+        """Calls command with text as its only argument, as msg's sender,
+        and hands its reply to deliver.  Replies coming more than
+        markovTimeout seconds later are dropped."""
+        command = callbacks.canonicalName(command)
+        cb = self._findCommand(irc, command)
+        if cb is None:
+            self.log.debug('No %s command to call.', command)
+            return
+        if not self._mayCall(msg, cb, command):
+            return
+        deadline = time.time() + self.registryValue('markovTimeout')
+        captured = CapturedReplyIrc(irc, msg, deliver, deadline)
+        def call():
+            try:
+                cb.callCommand([command], captured, msg, [text])
+            except Exception:
+                self.log.exception('Error calling %s:', command)
+        # This runs on whichever thread resolved the reaction, but a plugin
+        # which isn't threaded expects its commands to be called from the
+        # main loop, one at a time.
+        if cb.threaded:
+            thread = threading.Thread(target=call, name='Whatis-%s' % command)
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            schedule.addEvent(call, time.time())
 
     def _reply(self, channel, irc, msg, direct):
-        reaction = self.db.produceReaction(channel, ' '.join(msg.args[1:])).result()
-        self.log.info("Got reaction for %r: %r", ' '.join(msg.args[1:]), reaction)
+        text = ' '.join(msg.args[1:])
+        def react(reaction):
+            self.log.info("Got reaction for %r: %r", text, reaction)
+            if reaction and not direct and \
+                    not self._getBucket(channel).take():
+                return
+            self._react(channel, irc, msg, direct, reaction)
+        return self._later(self.db.produceReaction(channel, text), react)
 
+    def _react(self, channel, irc, msg, direct, reaction):
         if (reaction):
 
             self.explanations[channel] = reaction
-            tag, text = self.extractTag(reaction['reaction'])
-
-            text = text.replace('$nick', msg.nick)
+            template = reaction.get('template') or \
+                    matcher.Template(reaction['pattern'], reaction['reaction'])
+            tag = template.tag
+            text = template.render({'nick': msg.nick, 'who': msg.nick,
+                                    'channel': channel})
 
             if tag == 'action':
                 irc.reply(text, action=True)
             elif tag == 'reply':
                 irc.reply(text, prefixNick=direct)
             elif tag == 'markov':
-                proxy = QuietNestedCommandsIrcProxy(irc, msg,
-                        ['markov', text])
-                if proxy.savedReply:
-                    irc.reply(proxy.savedReply, prefixNick=direct)
+                self._callDirectly(irc, msg,
+                        self.registryValue('markov', channel), text,
+                        lambda s: irc.reply(s, prefixNick=direct))
             else:
-                irc.reply("%(pattern)s is %(reaction)s" % reaction, prefixNick=direct)
+                irc.reply(text, prefixNick=direct)
             return True
         else:
             return False
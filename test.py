@@ -30,8 +30,1024 @@
 
 from supybot.test import *
 
-class WhatisTestCase(PluginTestCase):
+import os
+import re
+import time
+import random
+import sqlite3
+import unittest
+import threading
+
+import supybot.conf as conf
+import supybot.plugins as plugins
+
+from . import aio
+from . import bench
+from . import timing
+from . import plugin
+from . import matcher
+
+# The database is registered as 'sqlite', which supybot.databases doesn't
+# list unless it is configured to.
+conf.supybot.databases.setValue(['sqlite'])
+
+class WhatisTestCase(ChannelPluginTestCase):
+    plugins = ('Whatis',)
+    config = {'supybot.plugins.Whatis.rate': 0}
+
+    def testLearnAndReact(self):
+        self.assertResponse('foo is bar', 'The operation succeeded.')
+        self.assertResponse('say foo please', 'foo is bar',
+                usePrefixChar=False)
+        self.assertResponse('foo is bar', 'I already knew that.')
+
+    def testForgetStopsReacting(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('forget ^foo$ is bar', 'The operation succeeded.')
+        self.assertNoResponse('foo', 1, usePrefixChar=False)
+
+    def testExplain(self):
+        self.assertResponse('explain', "I haven't said anything yet.")
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('^foo$ is baz', 'I now have 2 meanings for ^foo$.')
+        self.assertResponse('explain ^foo$',
+                "'^foo$' is instinct: P('bar')=1.0, instinct: P('baz')=1.0")
+        self.assertResponse('explain qux',
+                'I have no idea what you are talking about.')
+        self.assertRegexp('foo', r'\^foo\$ is ba[rz]', usePrefixChar=False)
+        self.assertRegexp('explain', r"instinct taught me that '\^foo\$' was")
+
+    def testForgetByPattern(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('^foo$ is baz', 'I now have 2 meanings for ^foo$.')
+        self.assertResponse('forget that ^foo$',
+                "You'll have to be more specific about what I'm forgetting.")
+        self.assertResponse('forget ^foo$ is baz', 'The operation succeeded.')
+        self.assertResponse('forget ^foo$', 'The operation succeeded.')
+        self.assertResponse('forget ^foo$',
+                "I don't remember anything about that.")
+
+    def testSuggestsSimilarPatterns(self):
+        self.assertResponse('^hello world$ is hi', 'The operation succeeded.')
+        self.assertResponse('explain hello world',
+                "I have no idea what you are talking about. Did you mean "
+                "'^hello world$'?")
+        self.assertResponse('forget ^helo world$',
+                "I don't remember anything about that. Did you mean "
+                "'^hello world$'?")
+        self.assertResponse('forget ^Helo world$ is hi',
+                "I don't remember anything about that. Did you mean "
+                "'^hello world$'?")
+        with conf.supybot.plugins.Whatis.suggestionDistance.context(0):
+            self.assertResponse('explain hello world',
+                    'I have no idea what you are talking about.')
+
+    def testExportImportCommands(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertRegexp('exportfile foo.csv', 'Exported 1 reactions')
+        self.assertRegexp('importfile #other foo.csv', 'Imported 1 of 1')
+        self.assertResponse('explain #other ^foo$',
+                            "'^foo$' is instinct: P('bar')=1.0")
+
+    def testVariables(self):
+        self.assertResponse('^foo$ is <reply>$channel has $who',
+                            'The operation succeeded.')
+        self.assertResponse('foo', '#test has test', usePrefixChar=False)
+
+    def testCachestats(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+        self.assertRegexp('cachestats', r'\(1 hits, \d+ misses\)')
+
+    def testStats(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+        self.assertRegexp('stats', r'addReaction: 1 calls, queued .*; '
+                          r'.*produceReaction: \d+ calls')
+        self.assertRegexp('stats #test', r'#test: 1 patterns \(1 indexed, '
+                          r'0 literal, 0 quarantined\), \d+ lookups \(0 cached\), \d+ patterns tried, '
+                          r'1 matched')
+
+    def testRefusesCatastrophicPattern(self):
+        self.assertResponse('(a+)+$ is bar', "I won't learn that, '(a+)+$' "
+                            "could take forever to match (nested "
+                            "quantifiers).")
+        self.assertResponse('explain (a+)+$',
+                            'I have no idea what you are talking about.')
+
+    def testQuarantined(self):
+        self.assertResponse('quarantined',
+                            'No patterns are quarantined in #test.')
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('quarantined',
+                            'No patterns are quarantined in #test.')
+
+    def testQueues(self):
+        self.assertRegexp('queues', r'#0: \d+ queued')
+
+class ProcessesTestCase(ChannelPluginTestCase):
+    plugins = ('Whatis',)
+    config = {'supybot.plugins.Whatis.rate': 0,
+              'supybot.plugins.Whatis.processes': 2}
+
+    def testLearnAndReact(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+        self.assertResponse('explain ^foo$', "'^foo$' is instinct: "
+                            "P('bar')=1.0")
+        self.assertRegexp('queues', r'#1: \d+ queued')
+
+@unittest.skipIf(aio.asyncio is None, 'asyncio needs Python 3')
+class AsyncioFacadeTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.loop = aio.asyncio.new_event_loop()
+        self.filename = conf.supybot.directories.data.dirize('Whatis.aio.db')
+        self.db = aio.AsyncioFacade(plugin.SQLiteWhatisDB, self.filename,
+                                    workers=2, loop=self.loop,
+                                    singleFile=True)
+
+    def tearDown(self):
+        self.db.timeout = None
+        self.loop.run_until_complete(self.db.close())
+        self.db.dispose()
+        self.loop.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        SupyTestCase.tearDown(self)
+
+    def testReactions(self):
+        run = self.loop.run_until_complete
+        self.failUnless(run(self.db.addReaction('#foo', 'a', 'b')))
+        self.assertEqual(run(self.db.produceReaction('#foo', 'xay'))
+                         ['reaction'], 'b')
+        self.assertEqual(len(run(self.db.getReactions('#foo', 'a'))), 1)
+        self.failUnless(run(self.db.forgetReaction('#foo', 'a', 'b')))
+        self.assertEqual(run(self.db.flush()), [0, 0])
+
+    def testChannelsAreComparedLikeIrcDoes(self):
+        self.assertEqual(self.db.key('#Foo[]'), '#foo{}')
+        self.failUnless(self.db._shardFor('#Foo[]') is
+                        self.db._shardFor('#foo{}'))
+
+    def testTimeout(self):
+        # Keep #foo's thread busy for longer than the timeout.
+        self.db._shardFor('#foo').executor.submit(time.sleep, 0.5)
+        self.db.timeout = 0.1
+        self.assertRaises(aio.asyncio.TimeoutError,
+                          self.loop.run_until_complete,
+                          self.db.getReactions('#foo', 'a'))
+
+    def testPromiseAdapter(self):
+        db = plugin.PromiseAdapter(self.db)
+        self.failUnless(db.addReaction('#foo', 'a', 'b').result())
+        self.assertEqual(db.getReactions('#foo', 'a').result()[0]['reaction'],
+                         'b')
+        self.assertEqual(len(db._stats()), 2)
+        self.failUnless('addReaction' in db._methodStats())
+
+class SQLiteWhatisDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        filename = conf.supybot.directories.data.dirize('Whatis.test.db')
+        self.db = plugin.SQLiteWhatisDB(filename, batchSize=3,
+                                        batchInterval=3600)
+        self.filename = plugins.makeChannelFilename(filename, '#test')
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.filename)
+        SupyTestCase.tearDown(self)
+
+    def committed(self):
+        db = sqlite3.connect(self.filename)
+        try:
+            return db.execute("SELECT COUNT(*) FROM Reactions").fetchone()[0]
+        finally:
+            db.close()
+
+    def testWritesAreBatched(self):
+        self.failUnless(self.db.addReaction('#test', 'a', 'b'))
+        self.failUnless(self.db.addReaction('#test', 'c', 'd'))
+        self.assertEqual(self.committed(), 0)
+        self.assertEqual(self.db.produceReaction('#test', 'a')['reaction'],
+                         'b')
+        self.failUnless(self.db.forgetReaction('#test', 'a', 'b'))
+        self.assertEqual(self.committed(), 1)
+        self.failUnless(self.db.addReaction('#test', 'e', 'f'))
+        self.assertEqual(self.db.flush(), 0)
+        self.assertEqual(self.committed(), 1)
+        self.assertEqual(self.db.flush(force=True), 1)
+        self.assertEqual(self.committed(), 2)
+
+    def testDurability(self):
+        self.db.getReactions('#test', 'a')
+        bounds = self.db.durability()
+        self.assertEqual(bounds['journal'], 'wal')
+        self.assertEqual(bounds['writes'], 2)
+
+    def testFlushCommitsWithinHalfAnInterval(self):
+        self.db.batchInterval = 0.2
+        self.failUnless(self.db.addReaction('#test', 'a', 'b'))
+        self.assertEqual(self.db.flush(), 0)
+        time.sleep(0.1)
+        self.assertEqual(self.db.flush(), 1)
+        self.assertEqual(self.committed(), 1)
+
+    def testExportImport(self):
+        for (pattern, reaction) in [('a', 'b'), ('c', 'd, "e"'), ('f', 'g')]:
+            self.db.addReaction('#test', pattern, reaction, 'nick', 2)
+        other = plugin.SQLiteWhatisDB(
+                conf.supybot.directories.data.dirize('Whatis.copy.db'))
+        try:
+            other.addReaction('#test', 'a', 'b')
+            for extension in ('jsonl', 'csv'):
+                filename = conf.supybot.directories.data.dirize(
+                        'reactions.' + extension)
+                self.assertEqual(
+                        self.db.exportReactions('#test', filename)[0], 3)
+                (read, inserted, elapsed) = \
+                        other.importReactions('#test', filename)
+                self.assertEqual((read, inserted),
+                                 (3, extension == 'jsonl' and 2 or 0))
+            self.assertEqual(other.getReactions('#test', 'c'),
+                             self.db.getReactions('#test', 'c'))
+            self.assertEqual(other.produceReaction('#test', 'f')['reaction'],
+                             'g')
+        finally:
+            other.close()
+            os.remove(plugins.makeChannelFilename(other.filename, '#test'))
+
+    def testLeastRecentlyUsedIsClosed(self):
+        self.db.maxOpen = 1
+        other = plugins.makeChannelFilename(self.db.filename, '#other')
+        try:
+            self.db.addReaction('#test', 'a', 'b')
+            self.assertEqual(self.committed(), 0)
+            self.db.addReaction('#other', 'c', 'd')
+            self.assertEqual(list(self.db.dbs), [other])
+            self.assertEqual(self.committed(), 1)
+            self.assertEqual(self.db.produceReaction('#test', 'a')['reaction'],
+                             'b')
+            self.assertEqual(list(self.db.dbs), [other])
+            self.assertEqual(self.db.getReactions('#test', 'a')[0]['reaction'],
+                             'b')
+            self.assertEqual(list(self.db.dbs), [self.filename])
+        finally:
+            self.db.close()
+            os.remove(other)
+
+    def testIdleFilesAreClosed(self):
+        self.db.idleTimeout = 3600
+        self.db.addReaction('#test', 'a', 'b')
+        self.assertEqual(self.db.flush(), 0)
+        self.assertEqual(list(self.db.dbs), [self.filename])
+        self.db.used[self.filename] -= 3600
+        self.assertEqual(self.db.flush(), 0)
+        self.assertEqual(list(self.db.dbs), [])
+        self.assertEqual(self.committed(), 1)
+
+    def testUpgrade(self):
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TABLE Reactions (pattern TEXT KEY, reaction TEXT KEY, person TEXT, frequency REAL)")
+        db.execute("CREATE UNIQUE INDEX reactionPair ON Reactions (pattern, reaction)")
+        db.executemany("INSERT INTO Reactions VALUES (?, ?, 'nick', 1)",
+                       [('foo', 'a'), ('foo', 'b'), ('fo+', 'c'), ('(c', 'd')])
+        db.execute("PRAGMA user_version=1")
+        db.commit()
+        db.close()
+        self.assertEqual(len(self.db.getReactions('#test', 'foo')), 2)
+        self.assertEqual(len(self.db.getReactions('#test', '(c')), 1)
+        self.assertEqual(self.db.produceReaction('#test', 'fo!')['reaction'],
+                         'c')
+        self.assertEqual(len(self.db._getMatcher('#test')), 2)
+        db = sqlite3.connect(self.filename)
+        try:
+            self.assertEqual(
+                db.execute("PRAGMA user_version").fetchone()[0],
+                plugin.bulk.SCHEMA)
+            self.assertEqual(db.execute("SELECT pattern, literal, keywords, "
+                    "valid FROM Reactions ORDER BY pattern, reaction").fetchall(),
+                    [('(c', 0, None, 0), ('fo+', 0, 'f', 1),
+                     ('foo', 1, 'foo', 1), ('foo', 1, 'foo', 1)])
+        finally:
+            db.close()
+
+    def testAnalyzedAgainByAnotherPython(self):
+        self.failUnless(self.db.addReaction('#test', 'fo+', 'a'))
+        self.db.close()
+        db = sqlite3.connect(self.filename)
+        db.execute("UPDATE Reactions SET keywords = 'x', valid = 0")
+        db.execute("UPDATE Meta SET value = 'Python 1.0, analyze 1'")
+        db.commit()
+        db.close()
+        self.db.matchers.clear()
+        self.assertEqual(self.db.produceReaction('#test', 'foo')['reaction'],
+                         'a')
+
+class BulkTestCase(SupyTestCase):
+    def testZeroFrequencyIsKept(self):
+        lines = ['{"pattern": "a", "reaction": "b", "frequency": 0.0}',
+                 '{"pattern": "c", "reaction": "d"}']
+        self.assertEqual([r[3] for r in plugin.bulk.readReactions(lines)],
+                         [0.0, 1.0])
+        lines = ['pattern,reaction,person,frequency', 'a,b,,0', 'c,d,,']
+        self.assertEqual([r[3] for r in
+                          plugin.bulk.readReactions(lines, 'csv')], [0.0, 1.0])
+
+class SingleFileWhatisDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('Whatis.one.db')
+        self.db = plugin.SQLiteWhatisDB(self.filename, singleFile=True)
+
+    def tearDown(self):
+        self.db.close()
+        os.remove(self.filename)
+        SupyTestCase.tearDown(self)
+
+    def testChannelsAreSeparate(self):
+        self.failUnless(self.db.addReaction('#foo', 'a', 'b'))
+        self.failUnless(self.db.addReaction('#Bar', 'a', 'c'))
+        self.failIf(self.db.addReaction('#FOO', 'a', 'b'))
+        self.assertEqual(len(self.db.dbs), 1)
+        self.assertEqual([r['reaction'] for r in
+                          self.db.getReactions('#bar', 'a')], ['c'])
+        self.assertEqual(self.db.produceReaction('#foo', 'a')['reaction'],
+                         'b')
+        self.failUnless(self.db.forgetReaction('#foo', 'a', 'b'))
+        self.assertEqual(self.db.getReactions('#foo', 'a'), [])
+        self.assertEqual(len(self.db.getReactions('#bar', 'a')), 1)
+
+    def testNoOpWritesDontHoldTheLock(self):
+        other = plugin.SQLiteWhatisDB(self.filename, singleFile=True)
+        try:
+            self.failUnless(self.db.addReaction('#foo', 'a', 'b'))
+            self.failIf(self.db.forgetReaction('#foo', 'nope', 'nope'))
+            self.failIf(self.db.addReaction('#foo', 'a', 'b'))
+            start = time.time()
+            self.failUnless(other.addReaction('#foo', 'c', 'd'))
+            self.failUnless(time.time() - start < 1)
+        finally:
+            other.close()
+
+    def testOpeningAnUpgradedFileDoesntWrite(self):
+        self.failUnless(self.db.addReaction('#foo', 'a', 'b'))
+        self.db.close()
+        lock = sqlite3.connect(self.filename)
+        other = plugin.SQLiteWhatisDB(self.filename, singleFile=True)
+        try:
+            lock.execute("BEGIN IMMEDIATE")
+            start = time.time()
+            self.assertEqual(len(other.getReactions('#foo', 'a')), 1)
+            self.failUnless(time.time() - start < 1)
+        finally:
+            lock.rollback()
+            lock.close()
+            other.close()
+
+    def testExportImport(self):
+        self.db.addReaction('#foo', 'a', 'b')
+        self.db.addReaction('#bar', 'c', 'd')
+        filename = conf.supybot.directories.data.dirize('reactions.jsonl')
+        self.assertEqual(self.db.exportReactions('#foo', filename)[0], 1)
+        self.assertEqual(self.db.importReactions('#baz', filename)[:2],
+                         (1, 1))
+        self.assertEqual(self.db.produceReaction('#baz', 'a')['reaction'],
+                         'b')
+        self.assertEqual(self.db.getReactions('#baz', 'c'), [])
+        self.assertEqual(self.db._getDb('#baz').execute(
+                "SELECT valid, patternHash FROM Reactions WHERE channel = ? ",
+                ('#baz',)).fetchall(), [(1, matcher.patternHash('a'))])
+
+class BenchTestCase(SupyTestCase):
+    def testShapes(self):
+        self.assertEqual(bench.parseShapes('word=2,regex=1'),
+                         [('word', 2.0), ('regex', 1.0)])
+        self.assertRaises(ValueError, bench.parseShapes, 'nope=1')
+        patterns = bench.makePatterns(random.Random(1), 20,
+                                      bench.parseShapes('word=1,regex=1'))
+        self.assertEqual(len(patterns), 20)
+        self.assertEqual(patterns, bench.makePatterns(random.Random(1), 20,
+                         bench.parseShapes('word=1,regex=1')))
+
+    def testRun(self):
+        class Options(object):
+            channels = 2
+            patterns = 20
+            messages = 20
+            lookups = 5
+            shapes = 'word=1,regex=1,unindexed=1'
+            corpus = None
+            workers = 2
+            batch_size = 10
+            cache_size = 0
+            memory = 300
+            processes = '1,2'
+            seed = 0
+            directory = conf.supybot.directories.data()
+        results = bench.run(Options(), plugin)
+        self.assertEqual(results['produceReaction']['ops'], 40)
+        self.assertEqual(results['addReaction']['ops'], 40)
+        self.assertEqual(results['suggestPatterns']['ops'], 10)
+        self.assertEqual(results['memory']['reactions'], 300)
+        self.assertEqual(results['scaling']['2']['ops'], 40)
+        self.failUnless(results['memory']['bytesPerReaction'] > 0)
+        for name in ('getReactions', 'facadeRoundTrip', 'loadMatchers'):
+            self.failUnless(results[name]['p99_ms'] >= 0)
+
+class HistogramTestCase(SupyTestCase):
+    def testPercentiles(self):
+        h = timing.Histogram()
+        for i in range(98):
+            h.add(0.0001)
+        h.add(0.5)
+        h.add(1.0)
+        summary = h.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['max'], 1.0)
+        self.failUnless(0.0001 <= summary['p50'] < 0.0002, summary)
+        self.failUnless(0.5 <= summary['p99'] <= 1.0, summary)
+        self.assertEqual(h.percentile(100), 1.0)
+
+    def testMerge(self):
+        h = timing.Histogram()
+        h.add(0.001)
+        other = timing.Histogram()
+        other.add(0.002)
+        self.assertEqual(h.merge(other).summary()['count'], 2)
+        self.assertEqual(h.max, 0.002)
+        self.assertEqual(timing.Histogram().summary()['p99'], 0)
+
+class PromiseTestCase(SupyTestCase):
+    def testAddDoneCallback(self):
+        p = plugin.Promise()
+        seen = []
+        p.addDoneCallback(lambda done: seen.append(done.result()))
+        self.assertEqual(seen, [])
+        p.finish(42)
+        self.assertEqual(seen, [42])
+        p.addDoneCallback(lambda done: seen.append(done.result()))
+        self.assertEqual(seen, [42, 42])
+
+    def testFromFuture(self):
+        class Future(object):
+            def __init__(self, value=None, error=None):
+                self.value = value
+                self.error = error
+            def add_done_callback(self, callback):
+                self.callback = callback
+            def exception(self):
+                return self.error
+            def result(self):
+                return self.value
+        future = Future(42)
+        p = plugin.Promise.fromFuture(future)
+        self.failIf(p.done())
+        future.callback(future)
+        self.assertEqual(p.result(), 42)
+        future = Future(error=ValueError('oops'))
+        p = plugin.Promise.fromFuture(future)
+        future.callback(future)
+        self.assertRaises(ValueError, p.result)
+
+    def testThen(self):
+        p = plugin.Promise()
+        chained = p.then(lambda v: v + 1)
+        p.finish(1)
+        self.assertEqual(chained.result(), 2)
+
+    def testThenFlattensPromises(self):
+        p = plugin.Promise()
+        inner = plugin.Promise()
+        chained = p.then(lambda v: inner)
+        p.finish(1)
+        self.failIf(chained.done())
+        inner.finish(3)
+        self.assertEqual(chained.result(), 3)
+
+    def testThenErrors(self):
+        p = plugin.Promise()
+        chained = p.then(lambda v: v)
+        recovered = p.then(lambda v: v, lambda e: str(e))
+        p.errored(ValueError('oops'))
+        self.assertRaises(ValueError, chained.result)
+        self.assertEqual(recovered.result(), 'oops')
+
+class MarkovTestCase(ChannelPluginTestCase):
+    plugins = ('Whatis', 'Utilities')
+    config = {'supybot.plugins.Whatis.rate': 0,
+              'supybot.plugins.Whatis.markov': 'echo'}
+
+    def testMarkov(self):
+        self.assertResponse('^foo$ is <markov>hi $nick', 'The operation '
+                            'succeeded.')
+        self.assertResponse('foo', 'hi test', usePrefixChar=False)
+        self.assertResponse('foo', 'hi test', usePrefixChar=False)
+        cb = self.irc.getCallback('Whatis')
+        self.assertEqual(cb.commands['echo'].name(), 'Utilities')
+        self.assertEqual(len(cb.capabilities), 1)
+
+    def testCommandRunsOnTheMainLoop(self):
+        cb = self.irc.getCallback('Utilities')
+        threads = []
+        def callCommand(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return type(cb).callCommand(cb, *args, **kwargs)
+        cb.callCommand = callCommand
+        try:
+            self.assertResponse('^foo$ is <markov>hi', 'The operation '
+                                'succeeded.')
+            self.assertResponse('foo', 'hi', usePrefixChar=False)
+        finally:
+            del cb.callCommand
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def testMissingCommand(self):
+        with conf.supybot.plugins.Whatis.markov.context('nonexistent'):
+            self.assertResponse('^foo$ is <markov>hi', 'The operation '
+                                'succeeded.')
+            self.assertNoResponse('foo', 1, usePrefixChar=False)
+
+    def testChannelCommand(self):
+        markov = conf.supybot.plugins.Whatis.markov
+        try:
+            markov.get(self.channel).setValue('nonexistent')
+            self.assertResponse('^foo$ is <markov>hi', 'The operation '
+                                'succeeded.')
+            self.assertNoResponse('foo', 1, usePrefixChar=False)
+        finally:
+            markov.unregister(self.channel)
+
+    def testLateReplyIsDropped(self):
+        with conf.supybot.plugins.Whatis.markovTimeout.context(1e-9):
+            self.assertResponse('^foo$ is <markov>hi', 'The operation '
+                                'succeeded.')
+            self.assertNoResponse('foo', 1, usePrefixChar=False)
+
+class AutoReplyTestCase(ChannelPluginTestCase):
     plugins = ('Whatis',)
+    config = {'supybot.plugins.Whatis.rate': 3600}
+
+    def testRateLimit(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+        self.assertNoResponse('foo', 1, usePrefixChar=False)
+
+    def testNoMatchDoesNotUseUpTheRate(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        self.assertNoResponse('qux', 1, usePrefixChar=False)
+        self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+
+    def testAutoreply(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        conf.supybot.plugins.Whatis.automaticReplies.setValue(False)
+        try:
+            self.assertNoResponse('foo', 1, usePrefixChar=False)
+        finally:
+            conf.supybot.plugins.Whatis.automaticReplies.setValue(True)
+
+    def testSavedAutoreplyDoesntSilence(self):
+        self.assertResponse('^foo$ is bar', 'The operation succeeded.')
+        with conf.supybot.plugins.Whatis.autoreply.context(False):
+            self.assertResponse('foo', '^foo$ is bar', usePrefixChar=False)
+
+    def testAutolearn(self):
+        conf.supybot.plugins.Whatis.autolearn.setValue(True)
+        try:
+            self.assertNoResponse('^foo$ is bar', 1, usePrefixChar=False)
+        finally:
+            conf.supybot.plugins.Whatis.autolearn.setValue(False)
+        self.assertResponse('explain ^foo$', "'^foo$' is test: P('bar')=1.0")
+
+class TokenBucketTestCase(SupyTestCase):
+    def testBucket(self):
+        bucket = plugin.TokenBucket(3600, 2)
+        self.failUnless(bucket.ready())
+        self.failUnless(bucket.take())
+        self.failUnless(bucket.take())
+        self.failIf(bucket.ready())
+        self.failIf(bucket.take())
+        bucket.last -= 1800
+        self.failIf(bucket.take())
+        bucket.last -= 1800
+        self.failUnless(bucket.take())
+
+    def testNoLimit(self):
+        bucket = plugin.TokenBucket(0)
+        for i in range(10):
+            self.failUnless(bucket.take())
+
+class FacadeTestCase(SupyTestCase):
+    class Wrapped(object):
+        def __init__(self):
+            self.thread = threading.currentThread()
+
+        def whereAmI(self, channel):
+            return self.thread
+
+        def fail(self, channel):
+            raise ValueError(channel)
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.facade = plugin.ThreadProtectionFacade(self.Wrapped, workers=4)
+
+    def tearDown(self):
+        self.facade._dispose()
+        SupyTestCase.tearDown(self)
+
+    def testChannelsStickToOneShard(self):
+        for channel in ['#foo', '#bar', '#baz']:
+            thread = self.facade.whereAmI(channel).result()
+            self.failIf(thread is threading.currentThread())
+            self.failUnless(self.facade.whereAmI(channel.upper()).result()
+                            is thread)
+
+    def testBroadcast(self):
+        threads = self.facade.whereAmI(None).result()
+        self.assertEqual(len(set(threads)), 4)
+
+    def testErrorsArePropagated(self):
+        self.assertRaises(ValueError, self.facade.fail('#foo').result)
+
+    def testStats(self):
+        self.facade.whereAmI('#foo').result()
+        stats = self.facade._stats()
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(sum([s['processed'] for s in stats]), 1)
+
+class ProcessFacadeTestCase(SupyTestCase):
+    class Wrapped(object):
+        def whereAmI(self, channel):
+            return os.getpid()
+
+        def fail(self, channel):
+            raise ValueError(channel)
+
+        def sockets(self, channel):
+            return plugin._openSockets()
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.facade = plugin.ProcessFacade(self.Wrapped, processes=3)
+
+    def tearDown(self):
+        self.facade._dispose()
+        SupyTestCase.tearDown(self)
+
+    def testChannelsStickToOneProcess(self):
+        for channel in ['#foo', '#bar', '#baz']:
+            pid = self.facade.whereAmI(channel).result()
+            self.assertNotEqual(pid, os.getpid())
+            self.assertEqual(self.facade.whereAmI(channel.upper()).result(),
+                             pid)
+
+    def testBroadcast(self):
+        pids = self.facade.whereAmI(None).result()
+        self.assertEqual(len(set(pids)), 3)
+
+    def testWorkersOnlyKeepTheirOwnPipe(self):
+        # The pipes to the workers forked before it are sockets too.
+        for sockets in self.facade.sockets(None).result():
+            self.assertEqual(len([fd for fd in sockets if fd > 2]), 1)
+
+    def testErrorsArePropagated(self):
+        self.assertRaises(ValueError, self.facade.fail('#foo').result)
+        self.assertRaises(AttributeError, self.facade.bogus('#foo').result)
+
+    def testCallbacksMayScheduleMore(self):
+        promises = []
+        def again(pid):
+            promises.append(self.facade.whereAmI('#foo'))
+        last = None
+        for i in range(200):
+            last = self.facade.whereAmI('#foo').then(again)
+        last.result()
+        for p in promises:
+            p.result()
+        self.assertEqual(len(promises), 200)
+        self.assertEqual(sum([s['processed']
+                              for s in self.facade._stats()]), 400)
+
+    def testDatabase(self):
+        filename = conf.supybot.directories.data.dirize('Whatis.procs.db')
+        db = plugin.ProcessFacade(plugin.SQLiteWhatisDB, filename,
+                                  processes=2)
+        try:
+            self.failUnless(db.addReaction('#foo', 'a', 'b').result())
+            self.assertEqual(db.produceReaction('#foo', 'xay').result()
+                             ['reaction'], 'b')
+            self.assertEqual(db.suggestPatterns('#foo', 'aa', 1).result(),
+                             [])
+            db.close().result()
+        finally:
+            db._dispose()
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class ChannelMatcherTestCase(SupyTestCase):
+    def testMatch(self):
+        m = matcher.ChannelMatcher([('fo+', 'bar', 'nick', 1),
+                                    ('^baz$', 'qux', 'nick', 1)])
+        self.assertEqual(m.match('xfoooo'), ['fo+'])
+        self.assertEqual(m.match('baz'), ['^baz$'])
+        self.assertEqual(m.match('baz!'), [])
+
+    def testInvalidPatternIsIgnored(self):
+        m = matcher.ChannelMatcher([('(c', 'a language', 'nick', 1)])
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.match('(c'), [])
+
+    def testPatternAnotherPythonCompiledIsIgnored(self):
+        m = matcher.ChannelMatcher([])
+        for literal in (False, True):
+            derived = (literal, None, True, None, matcher.patternHash('(c'))
+            self.failIf(m.add('(c', 'a language', 'nick', 1, derived))
+        self.assertEqual(len(m), 0)
+        self.assertEqual(m.match('(c'), [])
+
+    def testLiteralPatterns(self):
+        m = matcher.ChannelMatcher([('Foo', 'a', 'nick', 1),
+                                    (r'a\.b', 'b', 'nick', 1),
+                                    ('a.b', 'c', 'nick', 1)])
+        self.assertEqual(sorted(m.literals.items()),
+                         [('Foo', 'Foo'), (r'a\.b', 'a.b')])
+        self.assertEqual(m.compiled['Foo'], None)
+        self.assertEqual(m.match('xFoox'), ['Foo'])
+        self.assertEqual(m.match('foo'), [])
+        self.assertEqual(sorted(m.match('a.b')), ['a.b', r'a\.b'])
+        self.assertEqual(m.match('axb'), ['a.b'])
+        self.assertEqual(m.stats()['literal'], 2)
+        m.add('Fo', 'd', 'nick', 1)
+        self.assertEqual(sorted(m.match('xFoox')), ['Fo', 'Foo'])
+        self.assertTrue(m.remove('Foo', 'a'))
+        self.assertEqual(m.match('xFoox'), ['Fo'])
+        self.assertEqual(m.literals.get('Foo'), None)
+
+    def testRiskyPatternIsQuarantined(self):
+        m = matcher.ChannelMatcher([('(a+)+$', 'bar', 'nick', 1)])
+        self.assertEqual(m.quarantined, {'(a+)+$': 'nested quantifiers'})
+        self.assertEqual(m.match('aaaa'), [])
+        self.assertTrue(m.remove('(a+)+$', 'bar'))
+        self.assertEqual(m.quarantined, {})
+        self.assertEqual(len(m), 0)
+
+    def testSlowPatternIsQuarantined(self):
+        m = matcher.ChannelMatcher([('a.*b', 'slow', 'nick', 1)],
+                                   budget=1e-9)
+        for i in range(m.STRIKES - 1):
+            self.assertEqual(m.match('a' * 3000 + 'c' * i), [])
+            self.assertEqual(m.quarantined, {})
+        self.assertEqual(m.match('a' * 3000 + 'd'), [])
+        self.assertEqual(list(m.quarantined), ['a.*b'])
+        self.failUnless(m.quarantined['a.*b'].endswith(
+                        'to search %r' % ('a' * 40 + '...')))
+        m.budget = 0
+        self.assertEqual(m.match('ab'), [])
+        self.assertEqual(m.stats()['quarantined'], 1)
+
+    def testRiskyPatternIsTriedWithABudget(self):
+        m = matcher.ChannelMatcher([(r'(\d+\.)+\d+', 'version', 'nick', 1)],
+                                   budget=10)
+        self.assertEqual(m.quarantined, {})
+        self.assertEqual(m.match('version 1.2.3'), [r'(\d+\.)+\d+'])
+        m.budget = 1e-9
+        self.assertEqual(m.match('version 1.2.4'), [])
+        self.assertEqual(list(m.quarantined), [r'(\d+\.)+\d+'])
+
+    def testRemove(self):
+        m = matcher.ChannelMatcher([('foo', 'bar', 'nick', 1),
+                                    ('foo', 'baz', 'nick', 1)])
+        self.failUnless(m.remove('foo', 'bar'))
+        self.assertEqual(m.choose(m.match('foo'))['reaction'], 'baz')
+        self.failUnless(m.remove('foo', 'baz'))
+        self.failIf(m.remove('foo', 'baz'))
+        self.assertEqual(m.match('foo'), [])
+        self.assertEqual(m.choose(m.match('foo')), None)
+
+
+    def testPrefilterAgreesWithFullScan(self):
+        patterns = ['foo', 'fo+bar', '^hello world$', '(?i)HeLLo', 'a|bc',
+                    '(abc|de)f+', 'x*', r'\bcat\b', 'foo(bar)?baz', '[a-c]z',
+                    '(?s)foo', '(?m)hello', '(?x)foo bar', '[a]bc', '(?#c)foo',
+                    '(?:x)', u'\u03a3']
+        m = matcher.ChannelMatcher([(p, 'r', 'nick', 1) for p in patterns])
+        for text in ['', 'foo', 'fooooobar', 'hello world', 'HELLO there',
+                     'bc', 'abcff', 'concat', 'a cat', 'foobaz', 'bz', 'xyz',
+                     'foobar', 'foo bar', u'\u0391\u03a3']:
+            expected = sorted([p for p in patterns if re.search(p, text)])
+            self.assertEqual(sorted(m.match(text)), expected)
+
+    def testChooseIsProportionalToFrequency(self):
+        m = matcher.ChannelMatcher([('foo', 'a', 'nick', 1),
+                                    ('foo', 'b', 'nick', 2),
+                                    ('fo+', 'c', 'nick', 3),
+                                    ('fo+', 'd', 'nick', 4),
+                                    ('fo+', 'never', 'nick', 0)])
+        rng = random.Random(42)
+        draws = 20000
+        counts = dict.fromkeys('abcd', 0)
+        patterns = m.match('foo')
+        for i in range(draws):
+            counts[m.choose(patterns, rng)['reaction']] += 1
+        chi2 = 0.0
+        for (reaction, weight) in zip('abcd', [1, 2, 3, 4]):
+            expected = draws * weight / 10.0
+            chi2 += (counts[reaction] - expected) ** 2 / expected
+        # 16.27 is the 0.999 quantile of chi-squared with 3 degrees of freedom.
+        self.failUnless(chi2 < 16.27, (chi2, counts))
+
+    def testChooseNothingWeighted(self):
+        m = matcher.ChannelMatcher([('foo', 'a', 'nick', 0)])
+        self.assertEqual(m.choose(m.match('foo')), None)
+
+    def testCacheStaysExact(self):
+        m = matcher.ChannelMatcher([('foo', 'bar', 'nick', 1)])
+        self.assertEqual(m.match('foo bar'), ['foo'])
+        self.assertEqual(m.match('foo bar'), ['foo'])
+        self.assertEqual(m.cache.stats()['hits'], 1)
+        m.add('bar', 'baz', 'nick', 1)
+        self.assertEqual(sorted(m.match('foo bar')), ['bar', 'foo'])
+        m.remove('foo', 'bar')
+        self.assertEqual(m.match('foo bar'), ['bar'])
+        self.assertEqual(m.cache.stats(),
+                         {'size': 1, 'hits': 3, 'misses': 1})
+
+class TemplateTestCase(SupyTestCase):
+    variables = {'nick': 'bob', 'who': 'bob', 'channel': '#test'}
+
+    def testTags(self):
+        t = matcher.Template('hi', '<action>waves at $nick')
+        self.assertEqual(t.tag, 'action')
+        self.assertEqual(t.render(self.variables), 'waves at bob')
+        t = matcher.Template('hi', '<reply>$who, welcome to $channel!')
+        self.assertEqual(t.tag, 'reply')
+        self.assertEqual(t.render(self.variables), 'bob, welcome to #test!')
+
+    def testUntagged(self):
+        for reaction in ('a greeting for $nick', '<bogus>x'):
+            t = matcher.Template('hi', reaction)
+            self.assertEqual(t.tag, None)
+            self.assertEqual(t.slots, [])
+            self.assertEqual(t.render(self.variables), 'hi is ' + reaction)
+
+    def testUnknownVariable(self):
+        t = matcher.Template('hi', '<reply>$cost is $nicks$')
+        self.assertEqual(t.render(self.variables), '$cost is bobs$')
+
+class ReactionTestCase(SupyTestCase):
+    def testReadsLikeADict(self):
+        r = matcher.Reaction('hi', '<reply>hello $nick', 'bob', 2)
+        self.assertEqual(r['person'], 'bob')
+        self.assertEqual('%(pattern)s: %(reaction)s' % r,
+                         'hi: <reply>hello $nick')
+        self.assertEqual(r.get('template').tag, 'reply')
+        self.assertEqual(r.get('bogus'), None)
+        self.assertRaises(KeyError, r.__getitem__, 'bogus')
+        self.assertEqual(r, matcher.Reaction('hi', '<reply>hello $nick',
+                                             'bob', 2))
+        self.assertNotEqual(r, matcher.Reaction('hi', 'hello', 'bob', 2))
+
+    def testMatcherSharesStrings(self):
+        m = matcher.ChannelMatcher([('f' + 'oo', 'a', 'b' + 'ob', 1),
+                                    ('fo' + 'o', 'b', 'bo' + 'b', 1)])
+        (a, b) = m.reactions['foo']
+        self.failUnless(a.pattern is b.pattern)
+        self.failUnless(a.person is b.person)
+        m.add('foo', 'a', 'alice', 3)
+        self.assertEqual([(r.reaction, r.person) for r in m.reactions['foo']],
+                         [('a', 'alice'), ('b', 'bob')])
+
+class SimilarityIndexTestCase(SupyTestCase):
+    def testEditDistance(self):
+        self.assertEqual(matcher.editDistance('kitten', 'sitting', 5), 3)
+        self.assertEqual(matcher.editDistance('kitten', 'sitting', 2), 3)
+        self.assertEqual(matcher.editDistance('', 'abc', 5), 3)
+        self.assertEqual(matcher.editDistance('abc', 'abc', 0), 0)
+
+    def testSimilar(self):
+        index = matcher.SimilarityIndex(['hello world', 'hello there',
+                                         'goodbye', 'Hello World!',
+                                         'hello wyrld'])
+        self.assertEqual(index.similar('hello wrld', 2),
+                         ['hello world', 'hello wyrld'])
+        self.assertEqual(index.similar('hello wrld', 2, limit=1),
+                         ['hello world'])
+        self.assertEqual(index.similar('HELLO WORLD!', 2), ['Hello World!'])
+        self.assertEqual(index.similar('farewell', 2), [])
+        index.discard('hello world')
+        index.discard('hello wyrld')
+        self.assertEqual(index.similar('hello wrld', 2), ['Hello World!'])
+
+    def testShortTextsGetFewerEdits(self):
+        index = matcher.SimilarityIndex(['goodbye', 'bye'])
+        self.assertEqual(index.similar('godbye', 2), ['goodbye'])
+        self.assertEqual(index.similar('gdbye', 2), [])
+        self.assertEqual(index.similar('by', 2), [])
+
+    def testMatcherKeepsIndexCurrent(self):
+        m = matcher.ChannelMatcher([('^foo bar$', 'a', 'nick', 1)])
+        self.assertEqual(m.suggest('foo bar', 2), ['^foo bar$'])
+        m.add('^foo baz$', 'b', 'nick', 1)
+        self.assertEqual(m.suggest('foo baz', 2), ['^foo baz$'])
+        m.remove('^foo bar$', 'a')
+        self.assertEqual(m.suggest('foo bar', 2), [])
+
+class ResultCacheTestCase(SupyTestCase):
+    def testLeastRecentlyUsedIsEvicted(self):
+        cache = matcher.ResultCache(size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def testEntriesExpire(self):
+        cache = matcher.ResultCache(ttl=-1)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+class BacktrackingRiskTestCase(SupyTestCase):
+    def testRisky(self):
+        for pattern in ['(a+)+$', '(a*)*b', r'(\w+\s?)*$', '(x+x+)+y',
+                        '(a|a)*$', '(a|aa)+$', '((ab)*c)*', '(a|a?)+$',
+                        r'(.|\s)*x']:
+            self.assertNotEqual(matcher.backtrackingRisk(pattern), None,
+                                pattern)
+
+    def testSafe(self):
+        for pattern in ['foo', 'fo+bar', '^hello (world|there)$', 'a{2}+',
+                        '(ab){3}*', '(?:cat|dog)+', r'\bx+y+z+\b', 'c++']:
+            self.assertEqual(matcher.backtrackingRisk(pattern), None,
+                             pattern)
+
+class AnalyzeTestCase(SupyTestCase):
+    def testAnalyze(self):
+        self.assertEqual(matcher.analyze('foo bar'),
+                         (True, 'foo bar', True, None,
+                          matcher.patternHash('foo bar')))
+        self.assertEqual(matcher.analyze('(?i)foo')[0:3:2], (False, True))
+        self.assertEqual(matcher.analyze('cat|dog')[:3],
+                         (False, 'cat\ndog', True))
+        self.assertEqual(matcher.analyze('x*')[:3], (False, None, True))
+        self.assertEqual(matcher.analyze('(c')[:3], (False, None, False))
+        self.assertEqual(matcher.analyze('(a+)+$')[3], 'nested quantifiers')
+
+    def testStoredKeysAreUsed(self):
+        m = matcher.ChannelMatcher([('fo+', 'bar', 'nick', 1,
+                                     (False, 'oo', True, None, 0))])
+        self.assertEqual(m.keys, {'fo+': ('oo',)})
+        self.assertEqual(m.match('foo'), ['fo+'])
+        self.assertEqual(m.match('fo'), [])
+
+class LiteralKeysTestCase(SupyTestCase):
+    def testLiteralKeys(self):
+        self.assertEqual(matcher.literalKeys('foo'), frozenset(['foo']))
+        self.assertEqual(matcher.literalKeys('fo+bar'), frozenset(['bar']))
+        self.assertEqual(matcher.literalKeys('^Hello world$'),
+                         frozenset(['hello world']))
+        self.assertEqual(matcher.literalKeys('cat|dog'),
+                         frozenset(['cat', 'dog']))
+        self.assertEqual(matcher.literalKeys(r'\bcat\b'), frozenset(['cat']))
+
+    def testNoLiteralKeys(self):
+        self.assertEqual(matcher.literalKeys('x*'), None)
+        self.assertEqual(matcher.literalKeys('.+'), None)
+        self.assertEqual(matcher.literalKeys('foo|.'), None)
+
+    def testLiteralIndex(self):
+        index = matcher.LiteralIndex()
+        index.add('he', 1)
+        index.add('she', 2)
+        index.add('hers', 3)
+        self.assertEqual(index.search('ushers'), set([1, 2, 3]))
+        index.discard('she', 2)
+        self.assertEqual(index.search('ushers'), set([1, 3]))
+        self.assertEqual(index.search('his'), set())
+        index.add(u'\xfcber', 4)
+        self.assertEqual(index.search(u'\xdcber \xfcber'), set([4]))
 
+    def testLiteralIndexIsNotRebuiltForEveryChange(self):
+        index = matcher.LiteralIndex()
+        for i in range(100):
+            index.add('key%i' % i, i)
+        self.assertEqual(index.search('key7 key42'), set([7, 4, 42]))
+        automaton = index._goto
+        index.add('new', 100)
+        index.discard('key42', 42)
+        index.discard('key4', 4)
+        index.add('key4', 104)
+        self.assertEqual(index.search('key7 key42 new'), set([7, 104, 100]))
+        self.failUnless(index._goto is automaton)
+        for i in range(100):
+            index.discard('key%i' % i, i)
+        self.assertEqual(index.search('key7 key42 new'), set([104, 100]))
+        self.failIf(index._goto is automaton)
+        self.assertEqual(index.pending, set())
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -0,0 +1,91 @@
+###
+# Copyright (c) 2009-2014, Torrie Fischer
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+import math
+
+class Histogram(object):
+    """Counts durations in power-of-two buckets of microseconds, which is
+    cheap enough to do on every call and precise enough for percentiles.
+    Updates aren't locked, so concurrent writers may lose the odd count."""
+    BUCKETS = 32
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        micro = seconds * 1000000
+        if micro < 1:
+            i = 0
+        else:
+            i = min(math.frexp(micro)[1], self.BUCKETS - 1)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for (i, count) in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, p):
+        """Returns an upper bound for the p-th percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        wanted = p / 100.0 * self.count
+        seen = 0
+        for (i, count) in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min((2 ** i) / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'average': self.total / max(self.count, 1),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max
+        }
+
+def describe(summary):
+    """Formats a Histogram summary for humans."""
+    return '%.2f/%.2f/%.2fms avg/p99/max' % (summary['average'] * 1000,
+        summary['p99'] * 1000, summary['max'] * 1000)
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79: